@@ -1,14 +1,18 @@
 from django.contrib import admin
 
-from friends.models import Contact
+from friends.models import Contact, ImportJob
 from friends.models import Friendship, FriendshipInvitation, FriendshipInvitationHistory
-from friends.models import JoinInvitation
+from friends.models import JoinInvitation, OutboxMessage
 
 
 class ContactAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'email', 'user', 'added')
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'owner', 'type', 'status', 'imported', 'total', 'created')
+
+
 class FriendshipAdmin(admin.ModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'added',)
 
@@ -17,6 +21,10 @@ class JoinInvitationAdmin(admin.ModelAdmin):
     list_display = ('id', 'from_user', 'contact', 'status')
 
 
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'to_email', 'subject', 'status', 'attempts', 'created', 'sent')
+
+
 class FriendshipInvitationAdmin(admin.ModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'sent', 'status',)
 
@@ -26,7 +34,9 @@ class FriendshipInvitationHistoryAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Contact, ContactAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
 admin.site.register(Friendship, FriendshipAdmin)
 admin.site.register(JoinInvitation, JoinInvitationAdmin)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
 admin.site.register(FriendshipInvitation, FriendshipInvitationAdmin)
 admin.site.register(FriendshipInvitationHistory, FriendshipInvitationHistoryAdmin)
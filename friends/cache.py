@@ -0,0 +1,202 @@
+"""
+Versioned per-user friend adjacency cache.
+
+Each user's friend IDs are stored in Django's cache backend as a packed
+``array('i')`` under a key that includes the user's current version. Any
+change to one of the user's friendships bumps the version, so every process
+stops reading the old entry at once and it simply expires. The ``Friendship``
+signal handlers in ``friends.models`` and ``FriendshipManager.remove`` do the
+bumping.
+
+Hit and miss counts are kept per process and added to shared counters in the
+cache every STATS_FLUSH_EVERY reads; ``stats()`` reports the combined totals.
+"""
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+
+VERSION_KEY = "friends:version:%d"
+FRIEND_IDS_KEY = "friends:ids:%d:%d"
+STATS_KEY = "friends:stats:%s"
+SEPARATION_KEY = "friends:separation:%d:%d:%d:%d"
+FRIEND_IDS_TIMEOUT = getattr(settings, "FRIENDS_CACHE_TIMEOUT", 60 * 60 * 24)
+SEPARATION_TIMEOUT = getattr(settings, "FRIENDS_SEPARATION_TIMEOUT", 60 * 60)
+STATS_FLUSH_EVERY = 100
+
+_local_stats = {'hits': 0, 'misses': 0}
+
+
+def _user_id(user):
+    return getattr(user, "pk", user)
+
+
+def _new_version():
+    # a lost version key must never fall back to a number that was used
+    # before, so fresh versions start from the clock
+    return int(time.time() * 1000)
+
+
+def pack_ids(ids):
+    return array('i', sorted(ids)).tostring()
+
+
+def unpack_ids(packed):
+    ids = array('i')
+    ids.fromstring(packed)
+    return ids
+
+
+def contains(ids, user_id):
+    """ Binary search of a sorted friend ID array """
+    i = bisect_left(ids, user_id)
+    return i < len(ids) and ids[i] == user_id
+
+
+def _record(hits, misses):
+    _local_stats['hits'] += hits
+    _local_stats['misses'] += misses
+    if _local_stats['hits'] + _local_stats['misses'] >= STATS_FLUSH_EVERY:
+        flush_stats()
+
+
+def flush_stats():
+    """ Adds this process's counts to the shared counters in the cache """
+    for name in ('hits', 'misses'):
+        count, _local_stats[name] = _local_stats[name], 0
+        if not count:
+            continue
+        try:
+            cache.incr(STATS_KEY % name, count)
+        except ValueError:
+            if not cache.add(STATS_KEY % name, count, FRIEND_IDS_TIMEOUT):
+                cache.incr(STATS_KEY % name, count)
+
+
+def stats():
+    """ Returns the hit and miss counts across all processes """
+    flush_stats()
+    shared = cache.get_many([STATS_KEY % 'hits', STATS_KEY % 'misses'])
+    hits = shared.get(STATS_KEY % 'hits', 0)
+    misses = shared.get(STATS_KEY % 'misses', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': (hits + misses) and float(hits) / (hits + misses) or 0.0,
+    }
+
+
+def reset_stats():
+    _local_stats['hits'] = _local_stats['misses'] = 0
+    cache.delete_many([STATS_KEY % 'hits', STATS_KEY % 'misses'])
+
+
+def get_versions(users):
+    """ Returns a dict of user id -> current version, creating missing ones """
+    user_ids = [_user_id(u) for u in users]
+    found = cache.get_many([VERSION_KEY % user_id for user_id in user_ids])
+    versions = {}
+    for user_id in user_ids:
+        version = found.get(VERSION_KEY % user_id)
+        if version is None:
+            version = _new_version()
+            if not cache.add(VERSION_KEY % user_id, version, FRIEND_IDS_TIMEOUT):
+                version = cache.get(VERSION_KEY % user_id, version)
+        versions[user_id] = version
+    return versions
+
+
+def lookup(user):
+    """
+    Returns a tuple of (friend IDs or None on a miss, version). Pass the
+    version back to ``set_friend_ids`` so that a list read from the
+    database while the version was being bumped is never stored as current.
+    """
+    user_id = _user_id(user)
+    version = get_versions([user])[user_id]
+    packed = cache.get(FRIEND_IDS_KEY % (user_id, version))
+    if packed is None:
+        _record(0, 1)
+        return None, version
+    _record(1, 0)
+    return unpack_ids(packed), version
+
+
+def get_friend_ids(user):
+    """ Returns the cached friend IDs for ``user`` or None on a miss """
+    return lookup(user)[0]
+
+
+def lookup_many(users):
+    """
+    Returns a tuple of (dict of user id -> friend IDs for every cached user,
+    dict of user id -> version). Pass the versions to ``set_many_friend_ids``.
+    """
+    versions = get_versions(users)
+    keys = dict((FRIEND_IDS_KEY % (user_id, version), user_id) for user_id, version in versions.items())
+    found = cache.get_many(keys.keys())
+    _record(len(found), len(keys) - len(found))
+    return dict((keys[k], unpack_ids(v)) for k, v in found.items()), versions
+
+
+def get_many_friend_ids(users):
+    """ Returns a dict of user id -> friend IDs for every cached user """
+    return lookup_many(users)[0]
+
+
+def set_friend_ids(user, ids, version=None):
+    ids = array('i', sorted(ids))
+    if version is None:
+        version = get_versions([user])[_user_id(user)]
+    cache.set(FRIEND_IDS_KEY % (_user_id(user), version), ids.tostring(), FRIEND_IDS_TIMEOUT)
+    return ids
+
+
+def set_many_friend_ids(ids_by_user, versions):
+    """
+    Caches several friend ID lists in one round trip. ``versions`` is the
+    dict returned by ``lookup_many``. Returns a dict of user id -> sorted
+    friend ID array.
+    """
+    arrays = dict((user_id, array('i', sorted(ids))) for user_id, ids in ids_by_user.items())
+    cache.set_many(dict((FRIEND_IDS_KEY % (user_id, versions[user_id]), ids.tostring())
+        for user_id, ids in arrays.items()), FRIEND_IDS_TIMEOUT)
+    return arrays
+
+
+def bump_version(*users):
+    for user in users:
+        key = VERSION_KEY % _user_id(user)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), FRIEND_IDS_TIMEOUT)
+
+
+def _separation_key(user1_id, user2_id):
+    low, high = sorted([user1_id, user2_id])
+    versions = get_versions([low, high])
+    return SEPARATION_KEY % (low, versions[low], high, versions[high])
+
+
+def get_separation(user1, user2):
+    """
+    Returns the cached (distance, path of user IDs) from ``user1`` to
+    ``user2``, or None on a miss. The entry is keyed on both users' versions,
+    so it goes stale as soon as either of them gains or loses a friend;
+    changes further along the path only show up after SEPARATION_TIMEOUT.
+    """
+    user1_id, user2_id = _user_id(user1), _user_id(user2)
+    found = cache.get(_separation_key(user1_id, user2_id))
+    if found is None:
+        return None
+    distance, path = found
+    if path and path[0] != user1_id:
+        path = path[::-1]
+    return distance, path
+
+
+def set_separation(user1, user2, distance, path):
+    cache.set(_separation_key(_user_id(user1), _user_id(user2)), (distance, path), SEPARATION_TIMEOUT)
@@ -1,22 +1,239 @@
-import vobject
-
-def export_vcards(contacts):
-    result = []
-    for contact in contacts:
-        card = vobject.vCard()
-        card.add('n')
-        card.n.value = vobject.vcard.Name( family=contact.last_name, given=contact.first_name )
-        card.add('fn')
-        card.fn.value = contact.get_full_name()
-        card.add('email')
-        card.email.value = contact.email
-        card.email.type_param = 'INTERNET'
-        for phone in ["phone","mobile"]:
-            try:
-                tel = getattr(contact,phone)
-                card.add('tel')
-                card.tel.value = tel
-            except AttributeError:
-                pass
-        result.append(card.serialize())
-    return "\n".join(result)
+"""
+Contact export.
+
+Friends and address books are read in bounded batches and passed through a
+writer that turns each contact into a chunk of output, so exports of any
+size can be streamed. The built-in writers produce vCard 3.0, Outlook
+compatible CSV and JSON lines; more can be added through the
+FRIENDS_EXPORT_WRITERS setting, a dict of format name -> dotted class path.
+vCards are written directly as text instead of building a vobject tree
+per contact.
+"""
+import csv, datetime
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import User
+from django.utils import simplejson as json
+from django.utils.importlib import import_module
+
+from friends.models import Friendship, Contact, BULK_BATCH_SIZE, chunked
+
+LINE_LENGTH = 75 # octets, not counting the line break (RFC 2426)
+
+
+def escape(value):
+    """ Escapes a text value for a vCard property """
+    return (unicode(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+        .replace('\r\n', '\\n').replace('\n', '\\n').replace('\r', '\\n'))
+
+
+def fold(line):
+    """ Encodes a content line as UTF-8 and folds it at LINE_LENGTH octets """
+    line = line.encode('utf-8')
+    if len(line) <= LINE_LENGTH:
+        return line + '\r\n'
+    parts = []
+    limit = LINE_LENGTH
+    while len(line) > limit:
+        cut = limit
+        # don't split a multi-byte character
+        while cut > 1 and (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        # continuation lines start with a space, which counts towards the limit
+        limit = LINE_LENGTH - 1
+    parts.append(line)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def vcard(values):
+    """
+    Serializes one contact to a vCard 3.0 string. ``values`` is a dict that
+    may contain name, first_name, last_name, email, phone, mobile, fax,
+    address, website and birthday.
+    """
+    first_name = values.get('first_name') or ''
+    last_name = values.get('last_name') or ''
+    name = values.get('name') or ("%s %s" % (first_name, last_name)).strip() or values.get('email') or ''
+    lines = [
+        u"BEGIN:VCARD",
+        u"VERSION:3.0",
+        u"N:%s;%s;;;" % (escape(last_name), escape(first_name)),
+        u"FN:%s" % escape(name),
+    ]
+    if values.get('email'):
+        lines.append(u"EMAIL;TYPE=INTERNET:%s" % escape(values['email']))
+    for field, type in (('phone', 'VOICE'), ('mobile', 'CELL'), ('fax', 'FAX')):
+        if values.get(field):
+            lines.append(u"TEL;TYPE=%s:%s" % (type, escape(values[field])))
+    if values.get('address'):
+        lines.append(u"ADR:;;%s;;;;" % escape(values['address']))
+    if values.get('website'):
+        lines.append(u"URL:%s" % values['website'])
+    if values.get('birthday'):
+        lines.append(u"BDAY:%s" % values['birthday'].isoformat())
+    lines.append(u"END:VCARD")
+    return ''.join(fold(line) for line in lines)
+
+
+def user_values(user):
+    return {
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'name': user.get_full_name(),
+        'email': user.email,
+    }
+
+
+EXPORT_FIELDS = ('name', 'first_name', 'last_name', 'email', 'phone', 'mobile', 'fax', 'address', 'website', 'birthday')
+
+def contact_values(contact):
+    values = dict((field, getattr(contact, field, None)) for field in EXPORT_FIELDS)
+    values['owner_id'] = contact.owner_id
+    return values
+
+
+def iter_friends(user, batch_size=BULK_BATCH_SIZE):
+    """
+    Yields the friends of ``user`` as User objects ordered by last and
+    first name. Only the names are read up front to sort the (usually
+    cached) friend IDs; the users are then loaded one batch at a time so
+    memory use stays bounded.
+    """
+    names = []
+    for batch in chunked(Friendship.objects.friend_ids_for_user(user), batch_size):
+        names.extend(User.objects.filter(pk__in=batch).values_list('last_name', 'first_name', 'pk'))
+    names.sort()
+    for batch in chunked([pk for last_name, first_name, pk in names], batch_size):
+        friends = User.objects.only('first_name', 'last_name', 'email').in_bulk(batch)
+        for pk in batch:
+            if pk in friends:
+                yield friends[pk]
+
+
+def iter_contacts(contacts, batch_size=BULK_BATCH_SIZE):
+    """
+    Yields the contacts of a queryset as value dicts. Rows are read in
+    primary key order one batch at a time, loading only the exported
+    columns, so memory use stays bounded however large the queryset is.
+    """
+    contacts = contacts.only('owner', *EXPORT_FIELDS).order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(contacts.filter(pk__gt=last_pk)[:batch_size].iterator())
+        for contact in batch:
+            yield contact_values(contact)
+        if len(batch) < batch_size:
+            break
+        last_pk = batch[-1].pk
+
+
+def iter_friend_values(user, batch_size=BULK_BATCH_SIZE):
+    for friend in iter_friends(user, batch_size):
+        yield user_values(friend)
+
+
+def iter_vcards(items):
+    """ Yields one serialized card per User or Contact in ``items`` """
+    for item in items:
+        if isinstance(item, Contact):
+            yield vcard(contact_values(item))
+        else:
+            yield vcard(user_values(item))
+
+
+def export_vcards(items):
+    return ''.join(iter_vcards(items))
+
+
+class VCardWriter(object):
+    content_type = 'text/x-vcard; charset=utf-8'
+    extension = 'vcf'
+
+    def header(self):
+        return ''
+
+    def row(self, values):
+        return vcard(values)
+
+
+class OutlookCSVWriter(object):
+    """ Writes the columns the Outlook importer reads back """
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+    columns = (
+        ('Name', 'name'),
+        ('First Name', 'first_name'),
+        ('Last Name', 'last_name'),
+        ('E-mail Address', 'email'),
+        ('Business Phone', 'phone'),
+        ('Mobile Phone', 'mobile'),
+        ('Business Fax', 'fax'),
+        ('Business Street', 'address'),
+        ('Web Page', 'website'),
+        ('Birthday', 'birthday'),
+    )
+
+    def _line(self, cells):
+        out = StringIO()
+        csv.writer(out).writerow([unicode(cell).encode('utf-8') for cell in cells])
+        return out.getvalue()
+
+    def header(self):
+        return self._line([label for label, field in self.columns])
+
+    def row(self, values):
+        return self._line([values.get(field) is not None and values.get(field) or '' for label, field in self.columns])
+
+
+class JSONLinesWriter(object):
+    content_type = 'application/x-ndjson; charset=utf-8'
+    extension = 'jsonl'
+
+    def header(self):
+        return ''
+
+    def row(self, values):
+        values = dict((k, isinstance(v, datetime.date) and v.isoformat() or v) for k, v in values.items() if v is not None)
+        return json.dumps(values) + '\n'
+
+
+WRITERS = {
+    'vcard': VCardWriter,
+    'csv': OutlookCSVWriter,
+    'jsonl': JSONLinesWriter,
+}
+
+def export_formats():
+    """ Returns the names of the formats get_writer accepts """
+    return set(WRITERS).union(getattr(settings, "FRIENDS_EXPORT_WRITERS", {}))
+
+
+def get_writer(format):
+    """
+    Returns a writer instance for ``format``. Raises KeyError for unknown
+    formats and ImproperlyConfigured when FRIENDS_EXPORT_WRITERS names a
+    class that can't be imported.
+    """
+    path = getattr(settings, "FRIENDS_EXPORT_WRITERS", {}).get(format)
+    if not path:
+        writer = WRITERS[format]
+    else:
+        try:
+            module, name = path.rsplit('.', 1)
+            writer = getattr(import_module(module), name)
+        except (ValueError, ImportError, AttributeError), inst:
+            raise ImproperlyConfigured("Error loading export writer %r for format %r: %s" % (path, format, inst))
+    return writer()
+
+
+def export(writer, rows):
+    """ Yields the output of ``writer`` for an iterable of value dicts """
+    header = writer.header()
+    if header:
+        yield header
+    for values in rows:
+        yield writer.row(values)
@@ -269,4 +269,5 @@ class ContactForm(forms.ModelForm):
         
 
 class ImportContactForm(forms.Form):
-    contacts_file = forms.FileField(help_text="Upload a contacts file here. Current supported formats are vCard and Outlook.")
+    contacts_file = forms.FileField(widget=forms.FileInput(attrs={'multiple': 'multiple'}),
+        help_text="Upload one or more contacts files here. Current supported formats are vCard and Outlook, or a zip archive of them.")
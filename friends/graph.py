@@ -0,0 +1,259 @@
+"""
+Optional in-memory social graph.
+
+When FRIENDS_GRAPH_ENGINE is set, the whole ``Friendship`` edge list is loaded
+into a compressed sparse row structure: an ``offsets`` array with one entry
+per user and a ``neighbors`` array holding every user's sorted friend IDs
+back to back. Both are NumPy arrays when NumPy is installed and
+``array('i')`` otherwise. Degree, neighbor, friend-of-friend and distance
+queries then never touch the database.
+
+Edges added or removed in this process since the last build are kept in
+small overlay sets, fed by the ``Friendship`` signals in ``friends.models``.
+The graph is rebuilt from the database once it is older than
+FRIENDS_GRAPH_REBUILD_INTERVAL seconds or has collected
+FRIENDS_GRAPH_MAX_PENDING changes, which also picks up edges changed by
+other processes. Rebuilds run in a background thread; requests keep using
+the old graph and its overlay until the new one is swapped in.
+"""
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GRAPH_ENGINE = getattr(settings, "FRIENDS_GRAPH_ENGINE", False)
+REBUILD_INTERVAL = getattr(settings, "FRIENDS_GRAPH_REBUILD_INTERVAL", 15 * 60)
+MAX_PENDING = getattr(settings, "FRIENDS_GRAPH_MAX_PENDING", 10000)
+
+_graph = None
+_lock = threading.Lock() # guards _graph, _replay and _rebuilding
+_build_lock = threading.Lock() # one rebuild at a time
+_replay = None # edge changes signalled while a rebuild is loading
+_rebuilding = False
+
+
+class SocialGraph(object):
+
+    def __init__(self, edges=()):
+        """
+        Builds the graph from an iterable of (from user id, to user id)
+        pairs sorted by from user id and then to user id.
+        """
+        self.index = {}
+        offsets = array('i', [0])
+        neighbors = array('i')
+        current = None
+        for from_id, to_id in edges:
+            if from_id != current:
+                if current is not None:
+                    offsets.append(len(neighbors))
+                current = from_id
+                self.index[from_id] = len(self.index)
+            neighbors.append(to_id)
+        if current is not None:
+            offsets.append(len(neighbors))
+        if numpy is not None:
+            self.offsets = numpy.frombuffer(offsets, dtype=numpy.int32) if len(offsets) else numpy.zeros(1, dtype=numpy.int32)
+            self.neighbors = numpy.frombuffer(neighbors, dtype=numpy.int32) if len(neighbors) else numpy.zeros(0, dtype=numpy.int32)
+        else:
+            self.offsets = offsets
+            self.neighbors = neighbors
+        self.added = defaultdict(set)
+        self.removed = defaultdict(set)
+        self.pending = 0
+        self.built = time.time()
+
+    @classmethod
+    def from_database(cls):
+        from friends.models import Friendship
+        edges = Friendship.objects.order_by('from_user', 'to_user').values_list('from_user', 'to_user')
+        return cls(edges.iterator())
+
+    def is_stale(self):
+        return self.pending >= MAX_PENDING or time.time() - self.built >= REBUILD_INTERVAL
+
+    def _base_neighbors(self, user_id):
+        row = self.index.get(user_id)
+        if row is None:
+            return self.neighbors[0:0]
+        return self.neighbors[self.offsets[row]:self.offsets[row + 1]]
+
+    def neighbors_of(self, user_id):
+        """ Returns the sorted friend IDs of ``user_id`` """
+        base = self._base_neighbors(user_id)
+        if user_id not in self.added and user_id not in self.removed:
+            return base
+        ids = set(int(i) for i in base)
+        ids.update(self.added.get(user_id, ()))
+        ids.difference_update(self.removed.get(user_id, ()))
+        ids = sorted(ids)
+        if numpy is not None:
+            return numpy.array(ids, dtype=numpy.int32)
+        return array('i', ids)
+
+    def degree(self, user_id):
+        return len(self.neighbors_of(user_id))
+
+    def friends_of_friends(self, user_id):
+        """
+        Returns a dict of user id -> number of mutual friends for everyone
+        two hops from ``user_id`` who is not already a friend.
+        """
+        direct = self.neighbors_of(user_id)
+        if not len(direct):
+            return {}
+        excluded = set(int(i) for i in direct)
+        excluded.add(user_id)
+        if numpy is not None:
+            ids, counts = numpy.unique(numpy.concatenate([self.neighbors_of(int(f)) for f in direct]), return_counts=True)
+            return dict((i, c) for i, c in zip(ids.tolist(), counts.tolist()) if i not in excluded)
+        counts = defaultdict(int)
+        for friend_id in direct:
+            for candidate_id in self.neighbors_of(friend_id):
+                if candidate_id not in excluded:
+                    counts[candidate_id] += 1
+        return dict(counts)
+
+    def distance(self, user1_id, user2_id, max_depth=6):
+        """
+        Returns the number of hops between two users, or None if they are
+        not connected within ``max_depth`` hops. Searches from both ends,
+        always expanding the smaller frontier.
+        """
+        if user1_id == user2_id:
+            return 0
+        seen = [{user1_id: 0}, {user2_id: 0}]
+        frontiers = [[user1_id], [user2_id]]
+        depth = 0
+        while frontiers[0] and frontiers[1] and depth < max_depth:
+            side = len(frontiers[0]) > len(frontiers[1]) and 1 or 0
+            here, there = seen[side], seen[1 - side]
+            next_frontier = []
+            for user_id in frontiers[side]:
+                for friend_id in self.neighbors_of(user_id):
+                    friend_id = int(friend_id)
+                    if friend_id in there:
+                        return here[user_id] + 1 + there[friend_id]
+                    if friend_id not in here:
+                        here[friend_id] = here[user_id] + 1
+                        next_frontier.append(friend_id)
+            frontiers[side] = next_frontier
+            depth += 1
+        return None
+
+    def add_edge(self, user1_id, user2_id):
+        for a, b in ((user1_id, user2_id), (user2_id, user1_id)):
+            self.removed[a].discard(b)
+            self.added[a].add(b)
+        self.pending += 1
+
+    def remove_edge(self, user1_id, user2_id):
+        for a, b in ((user1_id, user2_id), (user2_id, user1_id)):
+            self.added[a].discard(b)
+            self.removed[a].add(b)
+        self.pending += 1
+
+
+def get_graph():
+    """
+    Returns the process-wide graph, or None when FRIENDS_GRAPH_ENGINE is
+    off. Only the very first call builds it inline; a stale graph is still
+    returned while a background thread rebuilds it.
+    """
+    global _graph
+    if not GRAPH_ENGINE:
+        return None
+    if _graph is None:
+        _build_lock.acquire()
+        try:
+            if _graph is None:
+                _graph = SocialGraph.from_database()
+        finally:
+            _build_lock.release()
+    elif _graph.is_stale():
+        start_rebuild()
+    return _graph
+
+
+def start_rebuild():
+    """ Starts a background rebuild unless one is already running; returns whether it did """
+    global _rebuilding
+    _lock.acquire()
+    try:
+        if _rebuilding:
+            return False
+        _rebuilding = True
+    finally:
+        _lock.release()
+    worker = threading.Thread(target=_rebuild_in_thread)
+    worker.daemon = True
+    worker.start()
+    return True
+
+
+def _rebuild_in_thread():
+    global _rebuilding
+    from django.db import connection
+    try:
+        rebuild()
+    finally:
+        _lock.acquire()
+        _rebuilding = False
+        _lock.release()
+        connection.close()
+
+
+def rebuild():
+    """
+    Loads a new graph from the database and swaps it in. Edges added or
+    removed in this process while it loads are replayed onto it, so they
+    aren't lost between the query and the swap.
+    """
+    global _graph, _replay
+    _build_lock.acquire()
+    try:
+        _lock.acquire()
+        _replay = []
+        _lock.release()
+        try:
+            graph = SocialGraph.from_database()
+            _lock.acquire()
+            try:
+                for change, user1_id, user2_id in _replay:
+                    getattr(graph, change)(user1_id, user2_id)
+                _graph = graph
+            finally:
+                _lock.release()
+        finally:
+            _lock.acquire()
+            _replay = None
+            _lock.release()
+    finally:
+        _build_lock.release()
+    return _graph
+
+
+def _record(change, user1_id, user2_id):
+    _lock.acquire()
+    try:
+        if _graph is not None:
+            getattr(_graph, change)(user1_id, user2_id)
+        if _replay is not None:
+            _replay.append((change, user1_id, user2_id))
+    finally:
+        _lock.release()
+
+
+def edge_added(user1_id, user2_id):
+    _record('add_edge', user1_id, user2_id)
+
+
+def edge_removed(user1_id, user2_id):
+    _record('remove_edge', user1_id, user2_id)
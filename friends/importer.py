@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.utils import simplejson as json
 
-import re
+import re, os, csv, datetime, itertools, multiprocessing, quopri, tempfile, threading, zipfile
 from collections import defaultdict
 
 try:
@@ -15,7 +15,10 @@ except ImportError:
     pass
 
 from django.contrib.auth.models import User
-from friends.models import Contact
+from django.core.files import File
+from django.db import connection, transaction
+from friends.models import Contact, GoogleToken, ImportJob, chunked
+from friends.merge import MERGE_ON_IMPORT, merge_duplicates
 
 EMAIL_REGEX = r".*?\b([A-Z0-9._%%+-]+@[A-Z0-9.-]+\.([A-Z]{2,4}|museum))\b.*"
 EMAIL_REGEX_MATCH = r"^%s$" % EMAIL_REGEX
@@ -27,222 +30,600 @@ def get_oauth_var(service, variable_key, settings=settings.OAUTH_SETTINGS):
     except KeyError:
         return None
 
-def import_outlook(stream, user):
-    import csv, tempfile
+IMPORT_BATCH_SIZE = getattr(settings, "FRIENDS_IMPORT_BATCH_SIZE", 500)
+IMPORT_WORKER = getattr(settings, "FRIENDS_IMPORT_WORKER", "command")
+IMPORT_PROCESSES = getattr(settings, "FRIENDS_IMPORT_PROCESSES", 2)
+MAX_ARCHIVE_MEMBER_SIZE = getattr(settings, "FRIENDS_MAX_ARCHIVE_MEMBER_SIZE", 20 * 2 ** 20)
+CHUNK_SIZE = 64 * 2 ** 10
+SNIFF_SIZE = 4096
+ZIP_MAGIC = 'PK\x03\x04'
+
+OUTLOOK_FIELD_LOOKUPS = {
+    'email': ["email","e-mail","e-mail address","email address"],
+    'first_name': ["first_name","first name","first","given name"],
+    'last_name': ["last_name","last name","last","family name"],
+    'name': ["name"],
+    'address': ['address'],
+    'street': ['street address','street','street_address'],
+    'city': ['city'],
+    'state': ['state','province'],
+    'zip': ['zip','zip code','zipcode','postal code','postal_code'],
+    'country': ['country'],
+    'phone':['phone','phone number'],
+    'fax':['fax','fax number'],
+    'mobile':['mobile','mobile phone'],
+    'website':['web page','url','website','home page','homepage'],
+    'birthday':['birthday','birth date','date of birth']
+}
+
+def iter_chunks(stream, chunk_size=CHUNK_SIZE):
     """
-    Imports the contents of an Outlook CSV file into the contacts of the given user
-    
-    Returns a tuple of (number imported, total number of records).
-    """ 
-    total = 0
-    imported = 0
-    #Contact.objects.filter(owner=user, type='O', user__isnull=True).delete()
-    # Fix lines that have breaks in them
-    # Determine the delimiter
-    csfile = None
-    if len(stream) < 100:
-        try:
-            csfile = open(stream,'rU')
-            stream = csfile.read(500)
-            csfile.close()
-            #print csfile.name
-        except IOError, inst:
-            #print "%s" % inst
-            pass
-    if not csfile:
-        csfile = tempfile.NamedTemporaryFile()
-        csfile.file.write(stream)
-        csfile.file.close()
-    csv_fields = stream[:500].split(",")
-    tsv_fields = stream[:500].split("\t")
-    if len(csv_fields) > len(tsv_fields):
-        delim = ","
+    Yields the raw contents of ``stream`` a chunk at a time. ``stream`` may
+    be an uploaded file, an open file, a path to a file, the file contents
+    as a string or any iterable of strings.
+    """
+    if hasattr(stream, 'chunks'):
+        for chunk in stream.chunks():
+            yield chunk
+    elif isinstance(stream, basestring):
+        if len(stream) < 100 and os.path.isfile(stream):
+            f = open(stream, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(chunk_size), ''):
+                    yield chunk
+            finally:
+                f.close()
+        else:
+            yield stream
+    elif hasattr(stream, 'read'):
+        for chunk in iter(lambda: stream.read(chunk_size), ''):
+            yield chunk
     else:
-        delim = "\t"
-    reader = csv.reader(open(csfile.name,'rU'),delimiter=delim)
-    lines = [row for row in reader]
-    fields = ('\t'.join(lines[0]).lower()).split('\t')
-    #print fields
-    field_lookups = {
-        'email': ["email","e-mail","e-mail address","email address"],
-        'first_name': ["first_name","first name","first","given name"],
-        'last_name': ["last_name","last name","last","family name"],
-        'name': ["name"],
-        'address': ['address'],
-        'street': ['street address','street','street_address'],
-        'city': ['city'],
-        'state': ['state','province'],
-        'zip': ['zip','zip code','zipcode','postal code','postal_code'],
-        'country': ['country'],
-        'phone':['phone','phone number'],
-        'fax':['fax','fax number'],
-        'mobile':['mobile','mobile phone'],
-        'website':['web page','url','website','home page','homepage']
-    }
+        for chunk in stream:
+            yield chunk
+
+def iter_lines(chunks):
+    """
+    Re-splits a sequence of chunks into lines terminated by a single "\n",
+    accepting "\r\n" or "\r" line endings even when they straddle chunks.
+    """
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.splitlines(True)
+        pending = ''
+        # keep a partial last line (or a bare "\r" that may be half of "\r\n") for the next chunk
+        if lines and (not lines[-1].endswith(('\n', '\r')) or lines[-1].endswith('\r')):
+            pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r\n') + '\n'
+    if pending:
+        yield pending.rstrip('\r\n') + '\n'
+
+def detect_format(chunk):
+    """ Guesses the contacts file format from its first chunk """
+    if chunk.startswith(ZIP_MAGIC):
+        return 'ZIP'
+    if 'VCARD' in chunk:
+        return 'VCARD'
+    ARBITRARY_FIELD_MINIMUM=5
+    first_line = chunk.split('\n')[0]
+    if len(first_line.split(',')) > ARBITRARY_FIELD_MINIMUM or len(first_line.split('\t')) > ARBITRARY_FIELD_MINIMUM:
+        return 'OUTLOOK'
+    return None
+
+def sniff_dialect(sample):
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=',\t;')
+    except csv.Error:
+        if len(sample.split(",")) > len(sample.split("\t")):
+            return csv.excel
+        return csv.excel_tab
+
+def map_outlook_fields(header):
+    """
+    Maps the columns of an Outlook header row to contact fields.
+    
+    Returns a dict of field name -> list of column indices.
+    """
+    fields = [f.strip().lower() for f in header]
     field_indices = defaultdict(list)
-    for field, lookups in field_lookups.items():
-        current_field = field
+    for field, lookups in OUTLOOK_FIELD_LOOKUPS.items():
         for lookup in lookups:
             for c in ["","work","business","home"]:
                 if len(c):
                     current_field = "%s_%s" % (c,field)
+                    current_lookup = "%s %s" % (c,lookup)
                 else:
                     current_field = field
-                #print "Current field is %s" % current_field
-                try:
-                    if len(c):
-                        current_lookup = "%s %s" % (c,lookup)
-                    else:
-                        current_lookup = lookup
-                    #print "Current lookup is %s" % current_lookup
-                    match = fields.index(current_lookup)
-                    if match > -1:
-                        #print "Field %d is a match for %s" % (match, lookup)
-                        field_indices[current_field].append(match)
-                except ValueError:
-                    pass
+                    current_lookup = lookup
+                if current_lookup in fields:
+                    field_indices[current_field].append(fields.index(current_lookup))
                 for i in range(1,5):
-                    try:
-                        match = fields.index("%s %d" % (current_lookup,i))
-                        field_indices[current_field.replace(' ','_')].append(match)
-                    except ValueError:
-                        pass
+                    numbered = "%s %d" % (current_lookup,i)
+                    if numbered in fields:
+                        field_indices[current_field.replace(' ','_')].append(fields.index(numbered))
+    return field_indices
+
+def guess_email_fields(lines):
+    """ Finds out which columns of a headerless file contain an email address """
+    email_fields=set()
+    for l in lines:
+        for f in range(0,len(l)):
+            if re.match(EMAIL_REGEX_MATCH, l[f], re.IGNORECASE):
+                email_fields.add(f)
+    return {'email': sorted(email_fields)}
+
+def parse_outlook_date(value):
+    """
+    Reads a date as Outlook writes it (month/day/year) or in ISO format;
+    returns None for Outlook's empty "0/0/00" and anything unreadable.
+    """
+    value = value.strip()
+    for format in ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y'):
+        try:
+            return datetime.datetime.strptime(value, format).date()
+        except ValueError:
+            pass
+    return None
+
+def outlook_values(line, field_indices):
+    """ Builds a dict of contact values from one Outlook row, or None if it has no email """
+    contact_vals = {}
+    for col, col_indices in field_indices.items():
+        for col_index in col_indices:
+            if col_index < len(line) and len(line[col_index].strip()):
+                if "street" in col and contact_vals.has_key(col):
+                    contact_vals[col]="%s, %s" % (contact_vals[col], line[col_index])
+                else:
+                    contact_vals[col]=line[col_index]
+                    if "street" not in col:
+                        break
+    if not contact_vals.has_key('email'):
+        if re.match(EMAIL_REGEX, (' ').join(line), re.IGNORECASE):
+            contact_vals['email'] = re.sub(EMAIL_REGEX, r"\1", (' ').join(line), re.IGNORECASE)
+    for c in ["","work_","business_","home_"]:
+        if contact_vals.has_key("%semail" % c):
+            email=contact_vals.pop("%semail" % c)
+            if not contact_vals.get('email',''):
+                contact_vals['email']=email
+        for field in ('phone', 'fax'):
+            if contact_vals.has_key("%s%s" % (c, field)):
+                number=contact_vals.pop("%s%s" % (c, field))
+                if not contact_vals.get(field,''):
+                    contact_vals[field]=number
+        if contact_vals.has_key("%saddress" % c):
+            addr=contact_vals.pop("%saddress" % c)
+            if not contact_vals.get('address',''):
+                contact_vals['address']=addr
+        street = contact_vals.pop(('%sstreet' % c),None)
+        city = contact_vals.pop(('%scity' % c),None)
+        state = contact_vals.pop(('%sstate' % c),None)
+        zip = contact_vals.pop(('%szip' % c),None)
+        if (street or city or state) and not contact_vals.has_key('address'):
+            address = ", ".join([part for part in (street, city, state) if part])
+            if zip:
+                address += " " + zip
+            contact_vals['address']=address
+    for extra in [k for k in contact_vals if k not in OUTLOOK_FIELD_LOOKUPS]:
+        del contact_vals[extra]
+    if contact_vals.has_key('birthday'):
+        birthday = parse_outlook_date(contact_vals.pop('birthday'))
+        if birthday:
+            contact_vals['birthday'] = birthday
+    if not contact_vals.get('name',None):
+        contact_vals['name']=("%s %s" % (contact_vals.get('first_name',''), contact_vals.get('last_name',''))).strip()
+    if contact_vals.has_key('email') and re.match(EMAIL_REGEX_MATCH,contact_vals['email'], re.IGNORECASE):
+        return contact_vals
+    return None
+
+def iter_outlook_contacts(stream):
+    """
+    Yields a dict of contact values for every row of an Outlook CSV/TSV
+    export that has an email address. The dialect is sniffed from the first
+    chunk and the header is mapped once; rows are parsed as they arrive.
+    """
+    chunks = iter_chunks(stream)
+    first_chunk = ''
+    for chunk in chunks:
+        first_chunk += chunk
+        if len(first_chunk) >= SNIFF_SIZE:
+            break
+    if not first_chunk:
+        return
+    dialect = sniff_dialect(first_chunk[:SNIFF_SIZE])
+    reader = csv.reader(iter_lines(itertools.chain([first_chunk], chunks)), dialect)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+    field_indices = map_outlook_fields(header)
     if len(field_indices):
-        # we are using the fields, so chop off the first line
-        #print lines[0]
-        lines = lines[1:]
-        #print "Now the first line is \n%s" % lines[0]
+        rows = reader
+    else:
+        # no recognisable header, so the first line is data
+        rows = itertools.chain([header], reader)
     if not field_indices.has_key('email'):
-        # Find out which fields contain an email address. That's all we're gathering.
-        hold_email_fields=set()
-        for l in lines[:10]:
-            for f in range(0,len(l)):
-                if re.match(EMAIL_REGEX_MATCH, l[f], re.IGNORECASE):
-                    hold_email_fields.add(f)
-        field_indices['email']=list(hold_email_fields)
-    print field_indices
-    if not (field_indices.has_key('email') and len(field_indices['email']) >= 1):
-        return 0, 0
-    for line in lines:
-        if not re.search(EMAIL_REGEX," ".join(line), re.IGNORECASE):
-            print "No email in this line: %s" % " ".join(line)
+        sample = list(itertools.islice(rows, 10))
+        field_indices.update(guess_email_fields(sample))
+        rows = itertools.chain(sample, rows)
+    if not field_indices['email']:
+        return
+    for line in rows:
+        if not line or not re.search(EMAIL_REGEX," ".join(line), re.IGNORECASE):
             continue
-        if len(line):
-            total += 1
-            contact_vals = {}
-            for col, col_indices in field_indices.items():
-                for col_index in col_indices:
-                    #print "Now looking at column %d in %s"  % (col_index, line)
-                    if len(line[col_index].strip()):
-                        if "street" in col:
-                            if contact_vals.has_key(col):
-                                contact_vals[col]="%s, %s" (contact_vals[col], line[col_index])
-                        else:
-                            contact_vals[col]=line[col_index]
-                            break
-            if not contact_vals.has_key('email'):
-                if re.match(EMAIL_REGEX, (' ').join(line), re.IGNORECASE):
-                    contact_vals['email'] = re.sub(EMAIL_REGEX, r"\1", (' ').join(line), re.IGNORECASE)
-            for c in ["","work_","business_","home_"]:
-                if contact_vals.has_key("%semail" % c):
-                    email=contact_vals.pop("%semail" % c)
-                    if not contact_vals.get('email',''):
-                        contact_vals['email']=email
-                if contact_vals.has_key("%sphone" % c):
-                    phone=contact_vals.pop("%sphone" % c)
-                    if not contact_vals.get('phone',''):
-                        contact_vals['phone']=phone
-                if contact_vals.has_key("%saddress" % c):
-                    addr=contact_vals.pop("%saddress" % c)
-                    if not contact_vals.get('address',''):
-                        contact_vals['address']=addr
-                street = contact_vals.pop(('%sstreet' % c),None)
-                city = contact_vals.pop(('%scity' % c),None)
-                state = contact_vals.pop(('%sstate' % c),None)
-                zip = contact_vals.pop(('%szip' % c),None)
-                if (street or city or state) and not contact_vals.has_key('address'):
-                    address = ""
-                    if street:
-                        address += street
-                    if city:
-                        if len(address):
-                            address += ", "
-                        address += city
-                    if state:
-                        if len(address):
-                            address += ", "
-                        address += state
-                    if zip and len(address):
-                        address += " " + zip
-                    contact_vals['address']=address
-            if not contact_vals.get('Name',None):
-                contact_vals['name']=("%s %s" % (contact_vals.get('first_name',''), contact_vals.get('last_name',''))).strip()
-            if contact_vals.has_key('email') and re.match(EMAIL_REGEX_MATCH,contact_vals['email'], re.IGNORECASE):
-                print "Creating contact record with these values: %s" % contact_vals.items()
-                contact, created = create_contact_from_values(owner=user, type='O', **contact_vals)
-                if contact:
-                    total += 1
-                if created:
-                    imported += 1
-            else:
-                print "Not importing, the values we got for this line were %s" % contact_vals.items()
-    return imported, total
-            
+        contact_vals = outlook_values(line, field_indices)
+        if contact_vals:
+            yield contact_vals
 
-def import_vcards(stream, user):
+def import_contacts(contacts, user, type, batch_size=IMPORT_BATCH_SIZE, progress=None):
     """
-    Imports the given vcard stream into the contacts of the given user.
+    Saves an iterable of contact value dicts for the given user in batches
+    of ``batch_size``. If given, ``progress`` is called with the running
+    (imported, total) counts after every batch.
     
-    Returns a tuple of (number imported, total number of cards).
+    Returns a tuple of (number imported, total number of records).
     """
-    
-    #Contact.objects.filter(owner=user, type='V', user__isnull=True).delete()
-    total = 0
     imported = 0
-    for card in vobject.readComponents(stream):
-        contact_vals = {}
+    total = 0
+    for batch in chunked(contacts, batch_size):
+        batch_imported, batch_total = save_contact_batch(user, type, batch)
+        imported += batch_imported
+        total += batch_total
+        if batch_imported and MERGE_ON_IMPORT:
+            # new contacts may duplicate ones already in the book under another
+            # email casing, a linked user or a shared name and phone number;
+            # merge_duplicate_contacts sweeps whole books
+            merge_duplicates(user, [values['email'] for values in batch if values.get('email')])
+        if progress:
+            progress(imported, total)
+    return imported, total
+
+def save_contact_batch(owner, type, batch):
+    return Contact.objects.bulk_upsert(owner, batch, type)
+
+def import_outlook(stream, user, progress=None):
+    """
+    Imports the contents of an Outlook CSV file into the contacts of the given user
+    
+    Returns a tuple of (number imported, total number of records).
+    """ 
+    return import_contacts(iter_outlook_contacts(stream), user, 'O', progress=progress)
+            
+
+VCARD_UNESCAPES = {'n': '\n', 'N': '\n', ',': ',', ';': ';', '\\': '\\', ':': ':'}
+VCARD_ESCAPE_RE = re.compile(r'\\(.)')
+
+class MalformedVCard(ValueError):
+    pass
+
+def vcard_unescape(value):
+    return VCARD_ESCAPE_RE.sub(lambda m: VCARD_UNESCAPES.get(m.group(1), m.group(1)), value)
+
+def vcard_components(value):
+    """ Splits a structured value such as N or ADR on unescaped semicolons """
+    parts = re.split(r'(?<!\\);', value)
+    return [vcard_unescape(p).strip() for p in parts]
+
+def parse_content_line(line):
+    """
+    Splits an unfolded vCard content line into (name, params, value). The
+    group prefix is dropped from the name, params is a dict of upper-cased
+    parameter name -> set of upper-cased values, and bare vCard 2.1
+    parameters such as "WORK" are treated as TYPE values.
+    """
+    in_quotes = False
+    for i, c in enumerate(line):
+        if c == '"':
+            in_quotes = not in_quotes
+        elif c == ':' and not in_quotes:
+            break
+    else:
+        raise MalformedVCard("content line without a value: %r" % line[:50])
+    head, value = line[:i], line[i + 1:]
+    parts = head.split(';')
+    name = parts[0].split('.')[-1].strip().upper()
+    params = {}
+    for param in parts[1:]:
+        if '=' in param:
+            key, values = param.split('=', 1)
+        else:
+            key, values = 'TYPE', param
+        params.setdefault(key.strip().upper(), set()).update(v.strip('" ').upper() for v in values.split(','))
+    if 'QUOTED-PRINTABLE' in params.get('ENCODING', ()):
+        value = quopri.decodestring(value)
+    elif params.get('ENCODING', set()) - set(['8BIT', '7BIT']):
+        raise MalformedVCard("unsupported encoding in %r" % line[:50])
+    charset = params.get('CHARSET')
+    if charset:
         try:
-            if card.fn.value != 'null':
-                contact_vals['name'] = card.fn.value
-            contact_vals['email'] = card.email.value
+            value = value.decode(list(charset)[0]).encode('utf-8')
+        except LookupError:
+            raise MalformedVCard("unknown charset in %r" % line[:50])
+    return name, params, value
+
+def iter_vcard_cards(stream):
+    """
+    Yields the content lines of each card in a vCard stream as a list of
+    unfolded strings, BEGIN and END included. Folded lines (continuations
+    starting with a space or tab) and quoted-printable soft line breaks
+    are joined as the stream is read.
+    """
+    card = None
+    pending = None
+    for line in iter_lines(iter_chunks(stream)):
+        line = line.rstrip('\n')
+        if pending is not None and line[:1] in (' ', '\t'):
+            pending += line[1:]
+            continue
+        if pending is not None and pending.endswith('=') and 'QUOTED-PRINTABLE' in pending.split(':', 1)[0].upper():
+            pending = pending[:-1] + line
+            continue
+        if pending is not None:
+            card = _add_vcard_line(card, pending)
+            if card and card[-1] is None:
+                yield card[:-1]
+                card = None
+        pending = line if line.strip() else None
+    if pending is not None:
+        card = _add_vcard_line(card, pending)
+        if card and card[-1] is None:
+            yield card[:-1]
+            card = None
+    if card:
+        # an unterminated last card is handed on so the fallback can try it
+        yield card
+
+def _add_vcard_line(card, line):
+    """ Appends ``line`` to the card being read; a trailing None marks the card complete """
+    upper = line.strip().upper()
+    if card is None:
+        if upper == 'BEGIN:VCARD':
+            return [line]
+        return None
+    card.append(line)
+    if upper == 'END:VCARD':
+        card.append(None)
+    return card
+
+def vcard_preference(params):
+    """
+    Returns the preference of a property, lower meaning more preferred:
+    the vCard 4 PREF=<1-100> parameter, 1 for a vCard 2.1/3.0 PREF type and
+    101 when neither is given.
+    """
+    values = [int(v) for v in params.get('PREF', ()) if v.isdigit()]
+    if 'PREF' in params.get('TYPE', ()):
+        values.append(1)
+    return values and min(values) or 101
+
+def parse_vcard(lines):
+    """
+    Builds a dict of contact values from the unfolded lines of one card,
+    reading only the properties Contact stores. Raises MalformedVCard if
+    the card can't be read this way.
+    """
+    if lines[-1].strip().upper() != 'END:VCARD':
+        raise MalformedVCard("card is not terminated")
+    contact_vals = {}
+    emails = []
+    for line in lines[1:-1]:
+        name, params, value = parse_content_line(line)
+        types = params.get('TYPE', set())
+        if name == 'FN':
+            value = vcard_unescape(value).strip()
+            if value and value != 'null':
+                contact_vals['name'] = value
+        elif name == 'N':
+            parts = vcard_components(value) + ['', '']
+            contact_vals['last_name'], contact_vals['first_name'] = parts[0], parts[1]
+        elif name == 'EMAIL':
+            emails.append((vcard_preference(params), len(emails), vcard_unescape(value).strip()))
+        elif name == 'TEL':
+            value = vcard_unescape(value).strip()
+            if 'CELL' in types or 'MOBILE' in types:
+                contact_vals.setdefault('mobile', value)
+            elif 'FAX' in types:
+                contact_vals.setdefault('fax', value)
+            elif vcard_preference(params) <= 100 or 'phone' not in contact_vals:
+                contact_vals['phone'] = value
+        elif name == 'ADR' and 'address' not in contact_vals:
+            parts = vcard_components(value) + [''] * 7
+            street, city, state, zip = parts[2], parts[3], parts[4], parts[5]
+            address = ", ".join([part for part in (street, city, state) if part])
+            if zip:
+                address = ("%s %s" % (address, zip)).strip()
+            if address:
+                contact_vals['address'] = address
+        elif name == 'URL' and 'website' not in contact_vals:
+            contact_vals['website'] = vcard_unescape(value).strip()
+        elif name == 'BDAY' and 'birthday' not in contact_vals:
+            digits = value.strip()[:10].replace('-', '')
             try:
-                name_field = card.contents.get('n')
-                try:
-                    contact_vals['last_name'] = name_field[0].value.family.strip()
-                    contact_vals['first_name'] = name_field[0].value.given.strip()
-                except:
-                    pass
-            except:
+                contact_vals['birthday'] = datetime.date(int(digits[:4]), int(digits[4:6]), int(digits[6:8]))
+            except ValueError:
                 pass
+    if emails:
+        contact_vals['email'] = min(emails)[2]
+    return contact_vals
 
+def vobject_card_values(card):
+    """ Builds a dict of contact values from a vobject card """
+    contact_vals = {}
+    try:
+        if card.fn.value != 'null':
+            contact_vals['name'] = card.fn.value
+        contact_vals['email'] = card.email.value
+    except AttributeError:
+        return contact_vals
+    try:
+        name_field = card.contents.get('n')
+        contact_vals['last_name'] = name_field[0].value.family.strip()
+        contact_vals['first_name'] = name_field[0].value.given.strip()
+    except:
+        pass
+
+    try:
+        for tel in card.contents.get('tel'):
             try:
-                for tel in card.contents.get('tel'):
-                    try:
-                        type = tel.params
-                    except AttributeError:
-                        type = []
-                    for t in type:
-                        if t == 'CELL' or t == 'MOBILE':
-                            contact_vals['mobile'] = tel.value
-                            break
-                        if t == 'FAX':
-                            contact_vals['fax'] = tel.value
-                            break
-                        else:
-                            if not contact_vals.has_key('phone') or t == 'pref': 
-                                contact_vals['phone'] = t.value
-                                break
-            except:
-                pass
+                type = tel.params
+            except AttributeError:
+                type = []
+            for t in type:
+                if t == 'CELL' or t == 'MOBILE':
+                    contact_vals['mobile'] = tel.value
+                    break
+                if t == 'FAX':
+                    contact_vals['fax'] = tel.value
+                    break
+                else:
+                    if not contact_vals.has_key('phone') or t == 'pref': 
+                        contact_vals['phone'] = tel.value
+                        break
+    except:
+        pass
+    return contact_vals
 
-            contact, created = create_contact_from_values(owner=user, type='V', **contact_vals)
-            if created:
-                imported += 1
-            if contact:
-                total += 1
-        except AttributeError:
-            pass # missing value so don't add anything
-    return imported, total
+def iter_vobject_contacts(stream):
+    """ The vobject based parser, kept for comparison in the benchmarks """
+    for card in vobject.readComponents(''.join(iter_chunks(stream))):
+        contact_vals = vobject_card_values(card)
+        if contact_vals.get('email'):
+            yield contact_vals
+
+def iter_vcard_contacts(stream):
+    """
+    Yields a dict of contact values for every card in the given vcard stream
+    that has an email address. Cards are parsed natively as they are read;
+    a card the native parser can't handle is re-read with vobject.
+    """
+    for lines in iter_vcard_cards(stream):
+        try:
+            contact_vals = parse_vcard(lines)
+        except MalformedVCard:
+            try:
+                contact_vals = vobject_card_values(vobject.readOne("\r\n".join(lines)))
+            except Exception:
+                continue # neither parser can read this card
+        if contact_vals.get('email'):
+            yield contact_vals
+
+def import_vcards(stream, user, progress=None):
+    """
+    Imports the given vcard stream into the contacts of the given user.
+    
+    Returns a tuple of (number imported, total number of cards).
+    """
+    return import_contacts(iter_vcard_contacts(stream), user, 'V', progress=progress)
+
+
+def bundle_files(files):
+    """
+    Packs several uploaded files into one zip archive, so that a single
+    import job can carry all of them. Returns a File to save on the job.
+    """
+    bundle = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    archive = zipfile.ZipFile(bundle, 'w', zipfile.ZIP_DEFLATED)
+    for i, f in enumerate(files):
+        archive.writestr("%d-%s" % (i, os.path.basename(f.name)), ''.join(iter_chunks(f)))
+    archive.close()
+    # File can't tell the size of an anonymous temporary file, and storage needs it
+    size = bundle.tell()
+    bundle.seek(0)
+    bundled = File(bundle, name='contacts.zip')
+    bundled.size = size
+    return bundled
+
+def iter_archive_members(archive):
+    """
+    Yields (name, contents) for every file in a zip archive that may hold
+    contacts, skipping folders, hidden files, Mac resource forks and
+    anything larger than MAX_ARCHIVE_MEMBER_SIZE.
+    """
+    archive = zipfile.ZipFile(archive)
+    try:
+        for info in archive.infolist():
+            basename = os.path.basename(info.filename)
+            if not basename or basename.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if info.file_size > MAX_ARCHIVE_MEMBER_SIZE:
+                continue
+            yield info.filename, archive.read(info)
+    finally:
+        archive.close()
+
+def parse_contacts_file(member):
+    """
+    Parses one (name, contents) pair into (name, list of contact value
+    dicts), tagging each dict with the contact type of its format. This
+    runs in the worker processes, so it must not touch the database.
+    """
+    name, contents = member
+    format = detect_format(contents[:SNIFF_SIZE])
+    if format == 'VCARD':
+        contacts, type = iter_vcard_contacts(contents), 'V'
+    elif format == 'OUTLOOK':
+        contacts, type = iter_outlook_contacts(contents), 'O'
+    else:
+        return name, []
+    rows = []
+    for contact_vals in contacts:
+        contact_vals['type'] = type
+        rows.append(contact_vals)
+    return name, rows
+
+def parse_contacts_files(members, processes=IMPORT_PROCESSES):
+    """
+    Yields parse_contacts_file results for an iterable of (name, contents)
+    pairs in order, spreading the parsing over a pool of ``processes``
+    worker processes when there is more than one.
+    """
+    if processes <= 1:
+        for member in members:
+            yield parse_contacts_file(member)
+        return
+    # the forked workers would share this process's database socket
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(parse_contacts_file, members):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def merge_contacts(contacts):
+    """
+    Merges contact value dicts that share an email address, ignoring case.
+    The first one seen wins; later ones only fill in fields it is missing.
+    """
+    merged = {}
+    order = []
+    for contact_vals in contacts:
+        key = contact_vals['email'].strip().lower()
+        if key in merged:
+            for field, value in contact_vals.items():
+                if value and not merged[key].get(field):
+                    merged[key][field] = value
+        else:
+            merged[key] = contact_vals
+            order.append(key)
+    return [merged[key] for key in order]
+
+def import_archive(stream, user, progress=None, processes=1):
+    """
+    Imports every vCard and Outlook file in a zip archive into the contacts
+    of the given user. Files are parsed by ``processes`` worker processes,
+    merged by email and then saved in one batched pass. Only pass more than
+    one process from a dedicated worker such as process_import_jobs, never
+    from a web process.
+    
+    Returns a tuple of (number imported, total number of unique records).
+    """
+    parsed = parse_contacts_files(iter_archive_members(stream), processes)
+    contacts = merge_contacts(contact_vals for name, rows in parsed for contact_vals in rows)
+    return import_contacts(contacts, user, None, progress=progress)
 
 
 def import_yahoo(bbauth_token, user):
@@ -290,7 +671,7 @@ def import_yahoo(bbauth_token, user):
     return imported, total
 
 
-def import_google(user):
+def import_google(user, progress=None):
     """
     Uses the given AuthSub token to retrieve Google Contacts and
     import the entries with an email address into the contacts of the
@@ -308,32 +689,37 @@ def import_google(user):
             get_oauth_var('GOOGLE','OAUTH_CONSUMER_KEY'), 
             consumer_secret=get_oauth_var('GOOGLE','OAUTH_CONSUMER_SECRET'))
     contacts_service.SetOAuthToken(OAuthToken(key=token.token, secret=token.token_secret, oauth_input_params=contacts_service._oauth_input_params))
-    entries = []
+    return import_contacts(iter_google_contacts(iter_google_entries(contacts_service)), user, 'G', progress=progress)
+
+def iter_google_entries(contacts_service):
+    """
+    Yields the entries of the contact groups we import from, fetching the
+    next page of the feed only when the previous one has been consumed.
+    """
+    from gdata.contacts.service import ContactsQuery
     groups = {}
-    result = ""
     query = ContactsQuery(feed='/m8/feeds/groups/default/full')
     feed = contacts_service.GetGroupsFeed(query.ToUri())
     SYS_GROUP_REGEX=r"\s*system group:\s*"
     for entry in feed.entry:
         groups[re.sub(SYS_GROUP_REGEX,"",entry.title.text.lower())]=entry.id.text
-    result+=("Groups: %s" % groups.items())
     for g in ["My Contacts","Friends","Coworkers"]:
-#        result += "\n Looking at %s" % g
         if groups.has_key(g.lower()):
-#            result += "\n Found %s" % g
             query = ContactsQuery()
             query.group=groups[g.lower()]
             feed = contacts_service.GetContactsFeed(query.ToUri())
-            entries.extend(feed.entry)
+            for entry in feed.entry:
+                yield entry
             next_link = feed.GetNextLink()
             while next_link:
                 feed = contacts_service.GetContactsFeed(uri=next_link.href)
-                entries.extend(feed.entry)
+                for entry in feed.entry:
+                    yield entry
                 next_link = feed.GetNextLink()
-    total = 0
-    imported = 0
-    imported_emails=[]
-#    raise Exception(result)
+
+def iter_google_contacts(entries):
+    """ Yields a dict of contact values for each Google Contacts entry with an email """
+    imported_emails=set()
     for entry in entries:
         contact_vals={}
         contact_vals['name'] = entry.title.text
@@ -344,14 +730,8 @@ def import_google(user):
             elif not contact_vals.has_key('email'):
                 contact_vals['email'] = e.address
         if contact_vals.has_key('email') and contact_vals['email'] not in imported_emails:
-            imported_emails.append(contact_vals['email'])
-            print "Creating record for %s" % contact_vals.items()
-            contact, created = create_contact_from_values(owner=user, type='G', **contact_vals)
-            if created:
-                imported += 1
-            if contact:
-                total += 1
-    return imported, total
+            imported_emails.add(contact_vals['email'])
+            yield contact_vals
 
 def create_contact_from_values(owner=None, type=None, **values):
     created = False
@@ -370,4 +750,64 @@ def create_contact_from_values(owner=None, type=None, **values):
         if type:
             contact.type = type 
         contact.save()
-    return contact, created
\ No newline at end of file
+    return contact, created
+
+def run_import_job(job, processes=1):
+    """
+    Runs an import job that has already been claimed by this worker,
+    recording progress on the job after every batch. Archives are parsed
+    with ``processes`` worker processes.
+    """
+    try:
+        if job.type == 'V':
+            imported, total = import_vcards(job.contacts_file, job.owner, progress=job.record_progress)
+        elif job.type == 'O':
+            imported, total = import_outlook(job.contacts_file, job.owner, progress=job.record_progress)
+        elif job.type == 'M':
+            imported, total = import_archive(job.contacts_file, job.owner, progress=job.record_progress, processes=processes)
+        elif job.type == 'G':
+            import gdata.service
+            try:
+                imported, total = import_google(job.owner, progress=job.record_progress)
+            except gdata.service.RequestError:
+                # the token was revoked or has expired, so the user has to authorize again
+                GoogleToken.objects.filter(user=job.owner).delete()
+                raise
+        else:
+            raise ValueError("Unknown import type %s" % job.type)
+    except Exception, inst:
+        job.fail("%s" % inst)
+    else:
+        job.finish(imported, total)
+    if job.contacts_file:
+        job.contacts_file.delete(save=False)
+    return job
+
+def _run_import_job_in_thread(job_id):
+    try:
+        job = ImportJob.objects.get(pk=job_id)
+        if ImportJob.objects.claim(job):
+            run_import_job(job)
+    except Exception, inst:
+        # nothing retries a job this thread has given up on, so don't leave it queued or running
+        ImportJob.objects.filter(pk=job_id, status__in=("1", "2")).update(
+            status="4", error="%s" % inst, finished=datetime.datetime.now())
+    finally:
+        connection.close()
+
+def start_import_job(job):
+    """
+    Hands a queued job to the configured worker. With the default
+    "command" worker it is left for ``manage.py process_import_jobs``.
+    With "thread" it runs in a background thread of this process; the
+    thread has its own connection, so any transaction the job was created
+    in is committed first. Daemon threads die with the process, so a
+    recycled web worker can leave jobs unfinished.
+    """
+    if IMPORT_WORKER == 'thread':
+        if transaction.is_managed():
+            transaction.commit()
+        worker = threading.Thread(target=_run_import_job_in_thread, args=(job.pk,))
+        worker.daemon = True
+        worker.start()
+    return job
@@ -0,0 +1,41 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from friends.exporter import export, export_formats, get_writer, iter_contacts
+from friends.models import Contact
+
+
+class Command(BaseCommand):
+    args = "[username ...]"
+    help = "Streams the address books of the given users, or with --all of every user, as vCard, Outlook CSV or JSON lines."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='jsonl',
+            help='vcard, csv or jsonl (the default, which keeps each contact\'s owner_id for backups).'),
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Export every user\'s address book.'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to write to; standard output by default.'),
+    )
+
+    def handle(self, *usernames, **options):
+        if bool(usernames) == bool(options.get('all')):
+            raise CommandError("Give one or more usernames, or --all")
+        if options.get('format') not in export_formats():
+            raise CommandError("Unknown export format: %s" % options.get('format'))
+        writer = get_writer(options.get('format'))
+        contacts = Contact.objects.all()
+        if usernames:
+            owners = list(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+            if len(owners) < len(set(usernames)):
+                raise CommandError("Unknown username in %s" % ", ".join(usernames))
+            contacts = contacts.filter(owner__in=owners)
+        output = options.get('output') and open(options['output'], 'wb') or sys.stdout
+        try:
+            for chunk in export(writer, iter_contacts(contacts)):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
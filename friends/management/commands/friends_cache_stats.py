@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import simplejson as json
+
+from friends import cache as friends_cache
+
+
+class Command(BaseCommand):
+    help = "Prints the friend cache hit and miss counters as JSON."
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Reset the counters after printing them.'),
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write("%s\n" % json.dumps(friends_cache.stats()))
+        if options.get('reset'):
+            friends_cache.reset_stats()
@@ -0,0 +1,98 @@
+import csv
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.utils import simplejson as json
+
+from friends.models import Friendship, BULK_BATCH_SIZE, chunked
+
+KEYS = ('id', 'username', 'email')
+
+
+def normalize(key, value):
+    if key == 'id':
+        return int(value)
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if key == 'email':
+        return value.strip().lower()
+    return value.strip()
+
+
+def read_csv(stream):
+    for row in csv.reader(stream):
+        if len(row) >= 2:
+            yield row[0].strip(), row[1].strip()
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        edge = json.loads(line)
+        if isinstance(edge, dict):
+            yield edge['from'], edge['to']
+        else:
+            yield edge[0], edge[1]
+
+
+class Command(BaseCommand):
+    args = "<edge list file, or - for stdin>"
+    help = "Creates friendships from a CSV (two columns) or JSON lines ({\"from\": .., \"to\": ..} or [from, to]) edge list, streaming it in batches."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default=None,
+            help='csv or jsonl; guessed from the file extension by default.'),
+        make_option('--key', action='store', dest='key', default='id',
+            help='How users are identified in the file: id, username or email.'),
+        make_option('--how-related', action='store', dest='how_related', default=None,
+            help='how_related value for every new friendship.'),
+        make_option('--skip-header', action='store_true', dest='skip_header', default=False,
+            help='Ignore the first line of the file.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=BULK_BATCH_SIZE,
+            help='Number of edges to resolve and commit per batch.'),
+    )
+
+    def handle(self, path=None, **options):
+        if not path:
+            raise CommandError("Give the path of an edge list file, or - to read stdin")
+        key = options.get('key')
+        if key not in KEYS:
+            raise CommandError("--key must be one of %s" % ", ".join(KEYS))
+        format = options.get('format') or (path.endswith('.jsonl') and 'jsonl' or 'csv')
+        if format not in ('csv', 'jsonl'):
+            raise CommandError("--format must be csv or jsonl")
+        verbosity = int(options.get('verbosity', 1))
+        stream = path == '-' and sys.stdin or open(path, 'rU')
+        try:
+            if options.get('skip_header'):
+                stream.readline()
+            edges = format == 'jsonl' and read_jsonl(stream) or read_csv(stream)
+            self.unresolved = 0
+            pairs = self.resolve(edges, key, options.get('batch_size'))
+            created = Friendship.objects.bulk_befriend(pairs, options.get('how_related'), options.get('batch_size'))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if verbosity:
+            self.stdout.write("Created %d friendships; %d edges named unknown users\n" % (created, self.unresolved))
+
+    def resolve(self, edges, key, batch_size):
+        """ Yields (user id, user id) pairs, looking users up one batch at a time """
+        for batch in chunked(edges, batch_size):
+            batch = [[normalize(key, v) for v in edge] for edge in batch]
+            values = list(set(v for edge in batch for v in edge))
+            if key == 'email':
+                placeholders = ', '.join(['%s'] * len(values))
+                users = User.objects.extra(where=['LOWER(email) IN (%s)' % placeholders], params=values)
+            else:
+                users = User.objects.filter(**{'%s__in' % key: values})
+            found = dict((normalize(key, v), pk) for pk, v in users.values_list('pk', key))
+            for edge in batch:
+                ids = [found.get(v) for v in edge]
+                if None in ids:
+                    self.unresolved += 1
+                else:
+                    yield ids[0], ids[1]
@@ -0,0 +1,34 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from friends.models import backfill_normalized_emails, link_users
+
+
+class Command(BaseCommand):
+    help = "Links users to the pending contacts and friend suggestions that carry their email address, for users created without post_save signals (bulk imports, SSO provisioning)."
+    option_list = BaseCommand.option_list + (
+        make_option('--since', action='store', dest='since', default=None,
+            help='Only link users who joined on or after this date (YYYY-MM-DD).'),
+        make_option('--backfill', action='store_true', dest='backfill', default=False,
+            help='First fill the normalized email column on existing contacts and suggestions.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options.get('backfill'):
+            contacts, suggestions = backfill_normalized_emails()
+            if verbosity:
+                self.stdout.write("Normalized emails on %d contacts and %d suggestions\n" % (contacts, suggestions))
+        users = User.objects.exclude(email='')
+        if options.get('since'):
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError("--since must be a date in YYYY-MM-DD format")
+            users = users.filter(date_joined__gte=since)
+        contacts, suggestions = link_users(list(users.order_by('pk').values_list('pk', flat=True)))
+        if verbosity:
+            self.stdout.write("Linked %d contacts and %d suggestions\n" % (contacts, suggestions))
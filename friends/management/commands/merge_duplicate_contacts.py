@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from friends.merge import merge_duplicates
+from friends.models import Contact
+
+
+class Command(BaseCommand):
+    args = "[username ...]"
+    help = "Merges duplicate contacts in the address books of the given users, or of every user with contacts."
+
+    def handle(self, *usernames, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if usernames:
+            owner_ids = list(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+            if len(owner_ids) < len(set(usernames)):
+                raise CommandError("Unknown username in %s" % ", ".join(usernames))
+        else:
+            owner_ids = Contact.objects.filter(owner__isnull=False).order_by().values_list('owner', flat=True).distinct()
+        books = 0
+        merged = 0
+        for owner_id in owner_ids:
+            # each book is merged and committed on its own
+            merged += merge_duplicates(User(pk=owner_id))
+            books += 1
+            if verbosity > 1 and books % 100 == 0:
+                self.stdout.write("Swept %d address books\n" % books)
+        if verbosity:
+            self.stdout.write("Merged %d duplicate contacts in %d address books\n" % (merged, books))
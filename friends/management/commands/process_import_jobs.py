@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from friends.models import ImportJob
+from friends.importer import IMPORT_PROCESSES, run_import_job
+
+
+class Command(BaseCommand):
+    help = "Runs queued contact import jobs. Use with FRIENDS_IMPORT_WORKER = 'command'."
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep polling for new jobs instead of exiting when the queue is empty.'),
+        make_option('--interval', action='store', type='int', dest='interval', default=5,
+            help='Seconds to wait between polls when looping.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            ran = 0
+            for job in list(ImportJob.objects.queued()):
+                if not ImportJob.objects.claim(job):
+                    continue
+                run_import_job(job, processes=IMPORT_PROCESSES)
+                ran += 1
+                if verbosity:
+                    self.stdout.write("%s: %d of %d records imported\n" % (job, job.imported, job.total))
+            if not options.get('loop'):
+                break
+            if not ran:
+                time.sleep(options.get('interval'))
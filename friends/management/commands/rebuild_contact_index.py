@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from friends.models import Contact, ContactSearchToken, chunked
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the contact search index used by friend_lookup."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=500,
+            help='Number of contacts to index per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        contact_ids = list(Contact.objects.all().order_by('pk').values_list('pk', flat=True))
+        indexed = 0
+        for batch in chunked(contact_ids, options.get('batch_size')):
+            ContactSearchToken.objects.index(Contact.objects.filter(pk__in=batch))
+            indexed += len(batch)
+            if verbosity > 1:
+                self.stdout.write("Indexed %d contacts\n" % indexed)
+        if verbosity:
+            self.stdout.write("Indexed %d contacts\n" % indexed)
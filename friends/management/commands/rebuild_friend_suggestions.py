@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from friends.models import chunked
+from friends.utils import build_friend_suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuilds friend suggestions for every active user, one batch of users at a time."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=500,
+            help='Number of users to load and commit per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        user_ids = User.objects.filter(is_active=True).order_by('pk').values_list('pk', flat=True)
+        users = 0
+        created = 0
+        deactivated = 0
+        for batch in chunked(list(user_ids), batch_size):
+            batch_created, batch_deactivated = self.rebuild_batch(batch)
+            users += len(batch)
+            created += batch_created
+            deactivated += batch_deactivated
+            if verbosity > 1:
+                self.stdout.write("Processed %d users\n" % users)
+        if verbosity:
+            self.stdout.write("Rebuilt suggestions for %d users: %d created, %d deactivated\n" % (users, created, deactivated))
+
+    @transaction.commit_on_success
+    def rebuild_batch(self, user_ids):
+        created = 0
+        deactivated = 0
+        for user in User.objects.filter(pk__in=user_ids):
+            batch_created, batch_deactivated = build_friend_suggestions(user)
+            created += batch_created
+            deactivated += batch_deactivated
+        return created, deactivated
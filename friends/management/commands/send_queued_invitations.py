@@ -0,0 +1,34 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from friends.models import OutboxMessage, chunked
+
+
+class Command(BaseCommand):
+    help = "Sends queued invitation emails, one connection per batch. Use with FRIENDS_QUEUE_INVITATIONS = True."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=100,
+            help='Number of messages to send over each connection.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep polling for new messages instead of exiting when the outbox is empty.'),
+        make_option('--interval', action='store', type='int', dest='interval', default=5,
+            help='Seconds to wait between polls when looping.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            sent = 0
+            failed = 0
+            for batch in chunked(list(OutboxMessage.objects.pending()), options.get('batch_size')):
+                batch_sent, batch_failed = OutboxMessage.objects.deliver(batch)
+                sent += batch_sent
+                failed += batch_failed
+            if verbosity and (sent or failed):
+                self.stdout.write("%d invitations sent, %d failed\n" % (sent, failed))
+            if not options.get('loop'):
+                break
+            if not sent:
+                time.sleep(options.get('interval'))
@@ -0,0 +1,190 @@
+"""
+Duplicate contact detection and merging.
+
+Every contact in an address book is reduced to a few hash keys: its
+normalized email, the user it is linked to, and its normalized name
+combined with each of its phone numbers. Contacts sharing any key are
+joined with a union-find, so finding the duplicates in a book is linear in
+its size. Each group is merged into the contact from the most trusted
+source (see MERGE_PRIORITY). The others are soft-deleted, and their join
+invitations are pointed at the survivor.
+"""
+import datetime, re
+
+from django.conf import settings
+from django.db import transaction
+
+from friends.models import Contact, ContactSearchToken, JoinInvitation, BULK_BATCH_SIZE, chunked, normalize_email
+
+# contact types, most trusted first: contacts made from a friendship or by
+# hand beat imported ones, and anything not listed comes last
+MERGE_PRIORITY = getattr(settings, "FRIENDS_MERGE_PRIORITY", ('F', 'A', 'G', 'O', 'V', 'M', 'I'))
+MERGE_ON_IMPORT = getattr(settings, "FRIENDS_MERGE_ON_IMPORT", True)
+MERGE_FIELDS = ('user', 'name', 'first_name', 'last_name', 'address', 'country', 'phone', 'fax', 'mobile', 'website', 'birthday')
+MIN_PHONE_DIGITS = 7
+
+NON_WORD_RE = re.compile(r'[\W_]+', re.UNICODE)
+NON_DIGIT_RE = re.compile(r'\D+')
+
+
+def normalize_name(contact):
+    name = contact.name or "%s %s" % (contact.first_name or '', contact.last_name or '')
+    # sorted words, so "Doe, Jane" and "Jane Doe" match
+    return " ".join(sorted(NON_WORD_RE.sub(' ', name.lower()).split()))
+
+
+def normalize_phone(phone):
+    digits = NON_DIGIT_RE.sub('', phone or '')
+    if len(digits) < MIN_PHONE_DIGITS:
+        return None
+    # ignore country and trunk prefixes
+    return digits[-10:]
+
+
+def match_keys(contact):
+    """ Returns the hash keys under which ``contact`` can match another contact """
+    keys = []
+    email = contact.email_normalized or normalize_email(contact.email)
+    if email:
+        keys.append(('email', email))
+    if contact.user_id:
+        keys.append(('user', contact.user_id))
+    name = normalize_name(contact)
+    if name:
+        for phone in (contact.phone, contact.mobile):
+            phone = normalize_phone(phone)
+            if phone:
+                keys.append(('phone', name, phone))
+    return keys
+
+
+def find_duplicates(contacts):
+    """ Returns the groups of two or more contacts in ``contacts`` that are the same person """
+    contacts = list(contacts)
+    parent = range(len(contacts))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_with_key = {}
+    for i, contact in enumerate(contacts):
+        for key in match_keys(contact):
+            j = first_with_key.setdefault(key, i)
+            if j != i:
+                parent[find(i)] = find(j)
+    groups = {}
+    for i, contact in enumerate(contacts):
+        groups.setdefault(find(i), []).append(contact)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def source_rank(contact):
+    try:
+        rank = list(MERGE_PRIORITY).index(contact.type)
+    except ValueError:
+        rank = len(MERGE_PRIORITY)
+    return (contact.user_id is None, rank, contact.pk)
+
+
+def merge_group(group):
+    """
+    Merges a group of duplicate contacts into the most trusted one. Each
+    field is taken from the most trusted contact that has it. Other
+    'Friendship' contacts are kept, since befriend maintains them. Returns
+    a tuple of (surviving contact, list of merged duplicates).
+    """
+    group = sorted(group, key=source_rank)
+    primary = group[0]
+    duplicates = [contact for contact in group[1:] if contact.type != 'F']
+    changed = {}
+    for field in MERGE_FIELDS:
+        attname = Contact._meta.get_field(field).attname
+        if getattr(primary, attname):
+            continue
+        for duplicate in duplicates:
+            value = getattr(duplicate, attname)
+            if value:
+                setattr(primary, attname, value)
+                changed[attname] = value
+                break
+    if changed:
+        primary.edited = datetime.date.today()
+        changed['edited'] = primary.edited
+        Contact.objects.get_query_set().filter(pk=primary.pk).update(**changed)
+    return primary, duplicates
+
+
+def contacts_matching(book, emails):
+    """
+    Returns the contacts in ``book`` with one of ``emails`` plus every
+    contact sharing a match key with them. Phones aren't stored in a
+    comparable form, so candidates are fetched by raw phone number or last
+    name and their keys are compared in memory.
+    """
+    found = {}
+    for batch in chunked(set(emails), BULK_BATCH_SIZE):
+        found.update((c.pk, c) for c in book.filter(email__in=batch))
+    keys = set(key for contact in found.values() for key in match_keys(contact))
+    lookups = {'email_normalized__in': set(), 'user__in': set(), 'phone__in': set(), 'mobile__in': set(), 'last_name__in': set()}
+    for contact in found.values():
+        lookups['email_normalized__in'].add(contact.email_normalized or normalize_email(contact.email))
+        lookups['user__in'].add(contact.user_id)
+        if normalize_name(contact):
+            for field in ('phone', 'mobile'):
+                phone = getattr(contact, field)
+                if normalize_phone(phone):
+                    lookups['phone__in'].add(phone)
+                    lookups['mobile__in'].add(phone)
+            lookups['last_name__in'].add(contact.last_name)
+    for lookup, values in lookups.items():
+        values.discard(None)
+        values.discard('')
+        for batch in chunked(values, BULK_BATCH_SIZE):
+            for contact in book.filter(**{lookup: batch}):
+                if contact.pk not in found and keys.intersection(match_keys(contact)):
+                    found[contact.pk] = contact
+    return found.values()
+
+
+@transaction.commit_on_success
+def merge_duplicates(owner, emails=None):
+    """
+    Finds and merges the duplicate contacts in the address book of
+    ``owner``. Duplicates are soft-deleted, so they keep their (owner,
+    email) slot and aren't imported again. Their join invitations are
+    moved to the surviving contact. Each group costs at most two updates;
+    the soft delete and the search index refresh are done for all groups
+    at once.
+
+    If ``emails`` is given, only the duplicates of the contacts with those
+    emails are merged, so the cost follows the number of emails rather
+    than the size of the book.
+
+    Returns the number of contacts merged away.
+    """
+    contacts = Contact.objects.filter(owner=owner).only(
+        'owner', 'email', 'email_normalized', 'type', 'edited', 'deleted', *MERGE_FIELDS)
+    if emails is not None:
+        contacts = contacts_matching(contacts, emails)
+    reindex = []
+    duplicate_ids = set()
+    for group in find_duplicates(contacts):
+        primary, duplicates = merge_group(group)
+        ids = [duplicate.pk for duplicate in duplicates]
+        JoinInvitation.objects.filter(contact__in=ids).update(contact=primary)
+        duplicate_ids.update(ids)
+        reindex.append(primary)
+        reindex.extend(duplicates)
+    if not duplicate_ids:
+        return 0
+    today = datetime.date.today()
+    Contact.objects.get_query_set().filter(pk__in=duplicate_ids).update(deleted=today)
+    for contact in reindex:
+        if contact.pk in duplicate_ids:
+            contact.deleted = today
+    # drops the duplicates' tokens and refreshes the survivors' merged names
+    ContactSearchToken.objects.index(reindex)
+    return len(duplicate_ids)
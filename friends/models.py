@@ -5,7 +5,7 @@ from random import random
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import signals
 from django.template.loader import render_to_string
 from django.utils.hashcompat import sha_constructor
@@ -13,11 +13,10 @@ from django.utils.hashcompat import sha_constructor
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 
-# favour django-mailer but fall back to django.core.mail
-if "mailer" in settings.INSTALLED_APPS:
-    from mailer import send_mail
-else:
-    from django.core.mail import send_mail
+from friends import cache as friends_cache
+from friends import graph as friends_graph
+
+from django.core.mail import EmailMessage, get_connection
 
 if "notification" in settings.INSTALLED_APPS:
     from notification import models as notification
@@ -32,11 +31,13 @@ else:
 
 __all__ = [
     "GoogleToken", 
-    "IMPORTED_TYPES", "CONTACT_TYPES", "Contact", 
+    "IMPORTED_TYPES", "CONTACT_TYPES", "Contact", "ContactSearchToken",
+    "IMPORT_JOB_STATUS", "ImportJob",
     "SUGGEST_BECAUSE_INVITE", "SUGGEST_BECAUSE_COWORKER", 
     "SUGGEST_BECAUSE_COAUTHOR", "SUGGEST_BECAUSE_FRIENDOFFRIEND", 
     "SUGGEST_BECAUSE_NEIGHBOR", "SUGGEST_WHY_CHOICES",
     "FriendSuggestion", "Friendship", "INVITE_STATUS", "JoinInvitation",
+    "OUTBOX_STATUS", "OutboxMessage",
     "FriendshipInvitation", "FriendshipInvitationHistory", "delete_friendship", "friendship_invitation"
 ]
     
@@ -48,6 +49,31 @@ except ImportError:
             kwargs.setdefault('max_length', 50) 
             super(models.CharField, self).__init__(*args, **kwargs) 
 
+# rows read or IN list items per statement; inserts are split further by
+# insert_batch_size, since each inserted row binds one parameter per column
+BULK_BATCH_SIZE = getattr(settings, "FRIENDS_BULK_BATCH_SIZE", 500)
+MAX_QUERY_PARAMETERS = 999 # SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+BEFRIEND_QUERY_PAIRS = 100
+
+def chunked(iterable, size=BULK_BATCH_SIZE):
+    """ Yields lists of at most ``size`` items from ``iterable`` """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def insert_batch_size(model):
+    """ Returns how many rows of ``model`` fit in one INSERT under MAX_QUERY_PARAMETERS """
+    return max(1, min(BULK_BATCH_SIZE, MAX_QUERY_PARAMETERS // len(model._meta.local_fields)))
+
+def normalize_email(email):
+    """ Returns the lowercased form of ``email`` that is stored and indexed for matching """
+    return email and email.strip().lower() or None
+
 class GoogleToken(models.Model):
     user = models.ForeignKey(User, related_name='googletokens')
     token = models.TextField()
@@ -81,18 +107,120 @@ class ContactManager(models.Manager):
         contact.name = user.get_full_name()
         contact.save()
         return contact, created
+    
+    def bulk_upsert(self, owner, rows, type=None):
+        """
+        Adds contacts for ``owner`` from an iterable of value dicts, leaving
+        emails the owner already has untouched. Each batch costs one query
+        for the owner's existing emails, one for matching users and one
+        bulk insert.
+        
+        Returns a tuple of (number imported, total number of records).
+        """
+        imported = 0
+        total = 0
+        for batch in chunked(rows, BULK_BATCH_SIZE):
+            by_email = {}
+            for values in batch:
+                email = values.get('email')
+                if email:
+                    total += 1
+                    by_email.setdefault(email, values)
+            if not by_email:
+                continue
+            # deleted contacts still occupy the (owner, email) unique key
+            existing = set(self.get_query_set().filter(owner=owner, email__in=by_email.keys()).values_list('email', flat=True))
+            new_emails = [email for email in by_email if email not in existing]
+            if not new_emails:
+                continue
+            lowered = list(set(email.lower() for email in new_emails))
+            users = {}
+            matching_users = User.objects.extra(where=['LOWER(email) IN (%s)' % ', '.join(['%s'] * len(lowered))], params=lowered)
+            for user_id, email in matching_users.values_list('pk', 'email'):
+                users.setdefault(email.lower(), user_id)
+            new_contacts = []
+            for email in new_emails:
+                contact = self.model(owner=owner, **by_email[email])
+                contact.user_id = users.get(email.lower())
+                contact.email_normalized = normalize_email(email)
+                if type:
+                    contact.type = type
+                contact.fill_name()
+                new_contacts.append(contact)
+            for chunk in chunked(new_contacts, insert_batch_size(self.model)):
+                self.bulk_create(chunk)
+            # bulk_create skips post_save, so index the new rows here
+            ContactSearchToken.objects.index(self.get_query_set().filter(owner=owner, email__in=new_emails))
+            imported += len(new_contacts)
+        return imported, total
+    
+    def add_friends(self, pairs):
+        """
+        Gives the owner of each (owner id, friend id) pair a 'Friendship'
+        contact for the friend. A contact the owner already has for the
+        friend's email is linked to the friend, renamed and undeleted;
+        missing ones are created in bulk. For up to BEFRIEND_QUERY_PAIRS pairs this costs a
+        fixed number of queries plus one update per contact that changes.
+        """
+        pairs = set(pairs)
+        user_ids = set(user_id for pair in pairs for user_id in pair)
+        users = dict((u[0], u) for u in User.objects.filter(pk__in=user_ids).values_list('pk', 'email', 'first_name', 'last_name'))
+        wanted = {}
+        for owner_id, user_id in pairs:
+            if owner_id in users and user_id in users and users[user_id][1]:
+                wanted[(owner_id, users[user_id][1])] = user_id
+        if not wanted:
+            return
+        
+        def values_for(user_id):
+            _, email, first_name, last_name = users[user_id]
+            contact = self.model(email=email, first_name=first_name, last_name=last_name)
+            contact.fill_name()
+            return {'user': user_id, 'first_name': first_name, 'last_name': last_name, 'name': contact.name, 'type': 'F', 'deleted': None}
+        
+        # deleted contacts still occupy the (owner, email) unique key
+        contacts = self.get_query_set().filter(owner__in=set(o for o, e in wanted), email__in=set(e for o, e in wanted))
+        found = set()
+        reindex = []
+        for contact in contacts:
+            key = (contact.owner_id, contact.email)
+            if key not in wanted:
+                continue
+            found.add(key)
+            values = values_for(wanted[key])
+            if [f for f, v in values.items() if getattr(contact, self.model._meta.get_field(f).attname) != v]:
+                self.get_query_set().filter(pk=contact.pk).update(**values)
+                for f, v in values.items():
+                    setattr(contact, self.model._meta.get_field(f).attname, v)
+                reindex.append(contact)
+        missing = []
+        for (owner_id, email), user_id in wanted.items():
+            if (owner_id, email) not in found:
+                values = values_for(user_id)
+                contact = self.model(owner_id=owner_id, user_id=values.pop('user'), email=email, email_normalized=normalize_email(email), **values)
+                missing.append(contact)
+        for batch in chunked(missing, insert_batch_size(self.model)):
+            self.bulk_create(batch)
+        # bulk_create skips post_save and doesn't set primary keys
+        created = set((c.owner_id, c.email) for c in missing)
+        reindex.extend(c for c in contacts.all() if (c.owner_id, c.email) in created)
+        ContactSearchToken.objects.index(reindex)
 
 
 IMPORTED_TYPES = (
     ("V", "VCard Import"),
     ("G", "Google Import"),
     ("O", "Outlook Import"),
+    ("M", "Archive Import"),
 )
 CONTACT_TYPES = (
     ("F", "Friendship"),
     ("I", "Invited"),
     ("A", "Manually added"),
 )
+WORD_SPLIT_RE = re.compile(r'\W+')
+CAPITALIZED_RE = re.compile(r'[A-Z][a-z]')
+
 class Contact(models.Model):
     """
     A contact is a person known by a user who may or may not themselves
@@ -108,6 +236,8 @@ class Contact(models.Model):
     address = models.CharField(max_length=500, null=True, blank=True)
     country = CountryField(null=True, blank=True)
     email = models.EmailField()
+    # lowercased email, indexed so new users can be matched to contacts
+    email_normalized = models.CharField(max_length=75, null=True, blank=True, db_index=True, editable=False)
     phone = models.CharField(max_length=50, null=True, blank=True)
     fax = models.CharField(max_length=50, null=True, blank=True)
     mobile = models.CharField(max_length=50, null=True, blank=True)
@@ -124,17 +254,21 @@ class Contact(models.Model):
     
     objects = ContactManager()
     
-    def save(self, *args, **kwargs):
+    def fill_name(self):
+        """ Derives a display name from the name fields or the email address """
         if self.email and not self.name and not (self.first_name or self.last_name):
-            name = ""
-            for w in re.split(r'\W+',self.email.split('@')[0]):
-                if not re.search(r'[A-Z][a-z]', w):
+            words = []
+            for w in WORD_SPLIT_RE.split(self.email.split('@')[0]):
+                if not CAPITALIZED_RE.search(w):
                     w = w.title()
-                name += " " + w
-                print "Now name is %s" % name
-            self.name = name.strip()
+                words.append(w)
+            self.name = " ".join(words).strip()
         if not self.name and (self.first_name or self.last_name):
-            self.name = ("%s %s" % (self.first_name, self.last_name)).strip()
+            self.name = ("%s %s" % (self.first_name or '', self.last_name or '')).strip()
+    
+    def save(self, *args, **kwargs):
+        self.fill_name()
+        self.email_normalized = normalize_email(self.email)
         super(Contact,self).save(*args, **kwargs)
         return self
     
@@ -160,18 +294,132 @@ class Contact(models.Model):
     class Meta:
         unique_together = (('owner','email'))
 
-def contact_update_user(sender, instance, created, *args, **kwargs):
-    if created:
-        Contact.objects.filter(email=instance.email).update(user=instance)
+SEARCH_TOKEN_LENGTH = 30
+MAX_SEARCH_TOKENS = 5
 
-def contact_create_for_friendship(sender, instance, created, *args, **kwargs):
-    if created:
-        contact1, _ = Contact.objects.create_from_user(instance.to_user, user=instance.from_user)
-        contact1.type = 'F'
-        contact1.save()
-        contact2, _ = Contact.objects.create_from_user(owner=instance.from_user, user=instance.to_user)
-        contact2.type = 'F'
-        contact2.save()
+def search_tokens(text):
+    """ Splits text into the lowercased words used by the contact search index """
+    return [w[:SEARCH_TOKEN_LENGTH] for w in WORD_SPLIT_RE.split((text or '').lower()) if w]
+
+class ContactSearchTokenManager(models.Manager):
+    
+    def index(self, contacts):
+        """
+        Replaces the search tokens of the given contacts with one delete
+        and one bulk insert.
+        """
+        contacts = list(contacts)
+        if not contacts:
+            return
+        self.filter(contact__in=[c.pk for c in contacts]).delete()
+        tokens = []
+        for contact in contacts:
+            if contact.deleted:
+                continue
+            words = set()
+            for text in (contact.name, contact.first_name, contact.last_name, contact.email.split('@')[0]):
+                words.update(search_tokens(text))
+            for word in words:
+                tokens.append(self.model(owner_id=contact.owner_id, contact_id=contact.pk, token=word))
+        for batch in chunked(tokens, insert_batch_size(self.model)):
+            self.bulk_create(batch)
+    
+    def search(self, owner, query):
+        """
+        Returns the owner's contacts with a name or email word starting
+        with every word in ``query``. Each word becomes one semi-join on the
+        (owner, token) index, so callers can order and slice the result in
+        the database.
+        """
+        tokens = search_tokens(query)[:MAX_SEARCH_TOKENS]
+        if not tokens:
+            return Contact.objects.none()
+        contacts = Contact.objects.filter(owner=owner)
+        for token in tokens:
+            contacts = contacts.filter(pk__in=self.filter(owner=owner, token__startswith=token).values('contact'))
+        return contacts
+
+class ContactSearchToken(models.Model):
+    """
+    One lowercased word from a contact's name or email address, used for
+    owner-scoped prefix search. See friends/sql/contactsearchtoken.sql for
+    the (owner, token) index.
+    """
+    
+    owner = models.ForeignKey(User, related_name="+", null=True)
+    contact = models.ForeignKey(Contact, related_name="search_tokens")
+    token = models.CharField(max_length=SEARCH_TOKEN_LENGTH)
+    
+    objects = ContactSearchTokenManager()
+
+def contact_update_search_tokens(sender, instance, raw=False, *args, **kwargs):
+    if not raw:
+        ContactSearchToken.objects.index([instance])
+
+IMPORT_JOB_STATUS = (
+    ("1", "Queued"),
+    ("2", "Running"),
+    ("3", "Finished"),
+    ("4", "Failed"),
+)
+
+class ImportJobManager(models.Manager):
+    
+    def queued(self):
+        return self.filter(status="1").order_by('created')
+    
+    def claim(self, job):
+        """
+        Marks a queued job as running. Returns False if another worker got
+        to it first.
+        """
+        return self.filter(pk=job.pk, status="1").update(status="2", started=datetime.datetime.now()) == 1
+
+class ImportJob(models.Model):
+    """
+    A contact import that runs outside of the request which started it.
+    Workers update the counters after every batch so the page that started
+    the import can poll for progress.
+    """
+    
+    owner = models.ForeignKey(User, related_name="import_jobs")
+    type = models.CharField(max_length=1, choices=IMPORTED_TYPES)
+    contacts_file = models.FileField(upload_to="friends/imports", null=True, blank=True)
+    status = models.CharField(max_length=1, choices=IMPORT_JOB_STATUS, default="1")
+    imported = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(default=datetime.datetime.now, editable=False)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    objects = ImportJobManager()
+    
+    def is_done(self):
+        return self.status in ("3", "4")
+    
+    def record_progress(self, imported, total):
+        self.imported, self.total = imported, total
+        ImportJob.objects.filter(pk=self.pk).update(imported=imported, total=total)
+    
+    def finish(self, imported, total):
+        self.imported, self.total = imported, total
+        self.status = "3"
+        self.finished = datetime.datetime.now()
+        self.save()
+    
+    def fail(self, error):
+        self.status = "4"
+        self.error = error
+        self.finished = datetime.datetime.now()
+        self.save()
+    
+    def __unicode__(self):
+        return "%s for %s (%s)" % (self.get_type_display(), self.owner, self.get_status_display())
+
+def contact_update_user(sender, instance, created, *args, **kwargs):
+    if created and instance.email:
+        Contact.objects.filter(email_normalized=normalize_email(instance.email), user__isnull=True).update(user=instance)
 
 SUGGEST_BECAUSE_INVITE=0
 SUGGEST_BECAUSE_COWORKER=1
@@ -196,10 +444,17 @@ class FriendSuggestionManager(models.Manager):
 
 class FriendSuggestion(models.Model):
     email = models.EmailField(null=True, blank=True)
+    email_normalized = models.CharField(max_length=75, null=True, blank=True, db_index=True, editable=False)
     user = models.ForeignKey(User, null=True, blank=True, related_name="suggested_friends")
     suggested_user = models.ForeignKey(User, related_name="__unused__")
     why = models.IntegerField(null=True, blank=True, choices=SUGGEST_WHY_CHOICES)
     active = models.BooleanField(default=True)
+    # number of mutual friends; see friends/sql/friendsuggestion.sql for the (user, active, -score) index
+    score = models.IntegerField(default=0)
+    
+    def save(self, *args, **kwargs):
+        self.email_normalized = normalize_email(self.email)
+        super(FriendSuggestion, self).save(*args, **kwargs)
     
     def show_why(self):
         for r in SUGGEST_WHY_CHOICES:
@@ -216,55 +471,213 @@ class FriendSuggestion(models.Model):
 
 def suggest_friend_from_invite(sender, instance, created, *args, **kwargs):
     if created:
-        FriendSuggestion.objects.get_or_create(suggested_user=instance.from_user, email=instance.contact.email, why=SUGGEST_BECAUSE_INVITE)
+        FriendSuggestion.objects.get_or_create(suggested_user=instance.from_user, email_normalized=normalize_email(instance.contact.email), why=SUGGEST_BECAUSE_INVITE, defaults={'email': instance.contact.email})
 
 def friendsuggestion_update_user(sender, instance, created, *args, **kwargs):
-    if created:
-        FriendSuggestion.objects.filter(email__iexact=instance.email,user__isnull=True).update(user=instance)
-        
-def friendship_destroys_suggestions(sender, instance, created, *args, **kwargs):
-    if created:
-        suggestions = FriendSuggestion.objects.filter(user=instance.to_user,suggested_user=instance.from_user)
-        suggestions |=  FriendSuggestion.objects.filter(user=instance.from_user,suggested_user=instance.to_user)
-        suggestions.update(active=False)
+    if created and instance.email:
+        FriendSuggestion.objects.filter(email_normalized=normalize_email(instance.email), user__isnull=True).update(user=instance)
+
+def link_users(user_ids):
+    """
+    Points pending contacts and friend suggestions at the users in
+    ``user_ids`` with a matching email. This is the set-based version of
+    ``contact_update_user`` and ``friendsuggestion_update_user`` for users
+    created in bulk, which skips their post_save signals. Each batch of
+    users costs one UPDATE per table, which finds its rows through the
+    ``email_normalized`` index.
+    
+    Returns a tuple of (contacts linked, suggestions linked).
+    """
+    qn = connection.ops.quote_name
+    users_table = qn(User._meta.db_table)
+    cursor = connection.cursor()
+    linked = {Contact: 0, FriendSuggestion: 0}
+    # every user id is bound twice
+    for batch in chunked(user_ids, min(BULK_BATCH_SIZE, MAX_QUERY_PARAMETERS // 2)):
+        placeholders = ', '.join(['%s'] * len(batch))
+        for model in linked:
+            table = qn(model._meta.db_table)
+            sql = ("UPDATE %(table)s SET %(user_id)s = (SELECT MIN(%(users)s.%(id)s) FROM %(users)s"
+                " WHERE %(users)s.%(id)s IN (%(ids)s) AND LOWER(%(users)s.%(email)s) = %(table)s.%(normalized)s)"
+                " WHERE %(normalized)s IN (SELECT LOWER(%(email)s) FROM %(users)s WHERE %(id)s IN (%(ids)s))"
+                # the unary plus keeps the planner off the user_id index, which
+                # covers every unlinked row, so it searches email_normalized
+                " AND +%(user_id)s IS NULL") % {
+                'table': table, 'users': users_table, 'ids': placeholders, 'id': qn('id'), 'user_id': qn('user_id'),
+                'email': qn('email'), 'normalized': qn('email_normalized')}
+            if model is Contact:
+                sql += " AND %s IS NULL" % qn('deleted')
+            cursor.execute(sql, list(batch) * 2)
+            linked[model] += cursor.rowcount
+    transaction.commit_unless_managed()
+    return linked[Contact], linked[FriendSuggestion]
 
+def backfill_normalized_emails():
+    """
+    Fills ``email_normalized`` on rows saved before the column existed.
+    Returns a tuple of (contacts updated, suggestions updated).
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    updated = []
+    for model in (Contact, FriendSuggestion):
+        cursor.execute("UPDATE %s SET %s = LOWER(TRIM(%s)) WHERE %s IS NULL AND %s IS NOT NULL" % (
+            qn(model._meta.db_table), qn('email_normalized'), qn('email'), qn('email_normalized'), qn('email')))
+        updated.append(cursor.rowcount)
+    transaction.commit_unless_managed()
+    return tuple(updated)
+        
 class FriendshipManager(models.Manager):
     
     def newest(self):
         return self.order_by('-added')
     
+    def friend_ids_for_user(self, user):
+        """
+        Returns a sorted array of the IDs of the user's friends, served from
+        the adjacency cache and filled from a single query on a miss.
+        """
+        ids, version = friends_cache.lookup(user)
+        if ids is None:
+            pairs = self.filter(models.Q(from_user=user) | models.Q(to_user=user)).values_list('from_user', 'to_user')
+            user_id = getattr(user, 'pk', user)
+            ids = set()
+            for from_id, to_id in pairs:
+                ids.add(to_id if from_id == user_id else from_id)
+            ids.discard(user_id)
+            ids = friends_cache.set_friend_ids(user, ids, version)
+        return ids
+    
+    def friend_count_for_user(self, user):
+        return len(self.friend_ids_for_user(user))
+    
+    def friend_users_for_user(self, user):
+        """ Returns the user's friends as a User queryset ordered by name """
+        return User.objects.filter(pk__in=list(self.friend_ids_for_user(user))).order_by('last_name', 'first_name')
+    
     def friends_for_user(self, user):
-        friends = []
-        already = []
-        me_friends = self.filter(from_user=user).select_related("to_user__pk","to_user__profile__pk","from_user__pk","from_user__profile__pk").order_by('to_user__last_name','to_user__first_name')
-        them_friends = self.filter(to_user=user).select_related("to_user__pk","to_user__profile__pk","from_user__pk","from_user__profile__pk").order_by('from_user__last_name','from_user__first_name')
-        all_friends = me_friends | them_friends
-        # give priority to "from" records. This is done by looping through them twice and only adding "to" records
-        # if absolutely necessary.
-        for friendship in all_friends:
-            if friendship.from_user_id == user.id:
-                friend = friendship.to_user
-                if friend.pk not in already:
-                    already.append(friend.pk)
-                    friends.append({"friend": friend, "how_related": None })
-        for friendship in all_friends:
-            if friendship.to_user_id == user.id:
-                friend = friendship.from_user
-                if friend.pk not in already:
-                    already.append(friend.pk)
-                    friends.append({"friend": friend, "how_related": None })
-        return sorted(friends, key=lambda k: "%s%s" % (k['friend'].last_name, k['friend'].first_name) )
+        return [{"friend": friend, "how_related": None } for friend in self.friend_users_for_user(user)]
     
     def are_friends(self, user1, user2):
-        if self.filter(from_user=user1, to_user=user2).count() > 0:
-            return True
-        if self.filter(from_user=user2, to_user=user1).count() > 0:
-            return True
-        return False
+        # a miss loads user1's friend IDs with one query and caches them,
+        # so later checks for user1 don't touch the database
+        return friends_cache.contains(self.friend_ids_for_user(user1), getattr(user2, 'pk', user2))
+    
+    def are_friends_many(self, user, candidate_ids):
+        """
+        Returns the subset of ``candidate_ids`` who are friends of ``user``
+        as a set, using a single query.
+        """
+        candidate_ids = list(candidate_ids)
+        if not candidate_ids:
+            return set()
+        ids = friends_cache.get_friend_ids(user)
+        if ids is not None:
+            return set(ids).intersection(candidate_ids)
+        return set(self.filter(from_user=user, to_user__in=candidate_ids).values_list('to_user', flat=True))
+    
+    @transaction.commit_on_success
+    def befriend(self, user1, user2, how_related=None):
+        """
+        Makes two users friends in one transaction with a fixed number of
+        statements: both Friendship directions, deleting the pair's friend
+        suggestions, marking friendship invitations between them accepted,
+        and a 'Friendship' contact for each of them in the other's address
+        book. post_save is sent for each new Friendship row so the cache,
+        graph and third-party receivers still hear about it.
+        
+        Returns a tuple of (friendship from user1 to user2, created).
+        """
+        pair = models.Q(from_user=user1, to_user=user2) | models.Q(from_user=user2, to_user=user1)
+        existing = set(self.filter(pair).values_list('from_user', 'to_user'))
+        today = datetime.date.today()
+        new = [
+            self.model(from_user=a, to_user=b, how_related=how_related, added=today)
+            for a, b in ((user1, user2), (user2, user1)) if (a.pk, b.pk) not in existing
+        ]
+        if not new:
+            return self.get(from_user=user1, to_user=user2), False
+        self.bulk_create(new)
+        
+        FriendSuggestion.objects.filter(
+            models.Q(user=user1, suggested_user=user2) | models.Q(user=user2, suggested_user=user1)
+        ).delete()
+        FriendshipInvitation.objects.filter(pair).update(status='5')
+        
+        Contact.objects.add_friends([(user1.pk, user2.pk), (user2.pk, user1.pk)])
+        
+        # bulk_create neither sets primary keys nor sends post_save
+        created = [f for f in self.filter(pair) if (f.from_user_id, f.to_user_id) not in existing]
+        for friendship in created:
+            signals.post_save.send(sender=self.model, instance=friendship, created=True, raw=False, using=self.db)
+        for friendship in created:
+            if friendship.from_user_id == user1.pk:
+                return friendship, True
+        # only the user2 -> user1 direction was missing
+        return self.get(from_user=user1, to_user=user2), True
+    
+    def bulk_befriend(self, pairs, how_related=None, batch_size=BULK_BATCH_SIZE):
+        """
+        Makes each (user id, user id) pair in ``pairs`` friends, for loading
+        whole social graphs at once. ``pairs`` may be any iterable and is
+        read one batch at a time. Pairs are deduplicated in either order,
+        and directions that already exist are skipped. Each batch is
+        committed on its own with a fixed number of statements; unlike
+        ``befriend`` no post_save signals are sent.
+        
+        Returns the number of Friendship rows created.
+        """
+        seen = set()
+        created = 0
+        for batch in chunked(pairs, batch_size):
+            unique = []
+            for user1_id, user2_id in batch:
+                pair = tuple(sorted((int(user1_id), int(user2_id))))
+                if pair[0] != pair[1] and pair not in seen:
+                    seen.add(pair)
+                    unique.append(pair)
+            if unique:
+                created += self._befriend_batch(unique, how_related)
+        return created
+    
+    @transaction.commit_on_success
+    def _befriend_batch(self, pairs, how_related):
+        # each query matches the pairs' user IDs against two columns, so
+        # BEFRIEND_QUERY_PAIRS keeps it well under MAX_QUERY_PARAMETERS
+        return sum(self._befriend_pairs(chunk, how_related) for chunk in chunked(pairs, BEFRIEND_QUERY_PAIRS))
+    
+    def _befriend_pairs(self, pairs, how_related):
+        user_ids = set(user_id for pair in pairs for user_id in pair)
+        wanted = set(pairs)
+        wanted.update((b, a) for a, b in pairs)
+        existing = set(self.filter(from_user__in=user_ids, to_user__in=user_ids).values_list('from_user', 'to_user'))
+        today = datetime.date.today()
+        new = [self.model(from_user_id=a, to_user_id=b, how_related=how_related, added=today) for a, b in wanted - existing]
+        for batch in chunked(new, insert_batch_size(self.model)):
+            self.bulk_create(batch)
+        
+        # IN lists matched in memory rather than one OR term per pair,
+        # which overflows SQLite's expression depth on large batches
+        suggestions = FriendSuggestion.objects.filter(user__in=user_ids, suggested_user__in=user_ids)
+        stale = [pk for pk, a, b in suggestions.values_list('pk', 'user', 'suggested_user') if (a, b) in wanted]
+        if stale:
+            FriendSuggestion.objects.filter(pk__in=stale).delete()
+        invitations = FriendshipInvitation.objects.filter(from_user__in=user_ids, to_user__in=user_ids)
+        accepted = [pk for pk, a, b in invitations.values_list('pk', 'from_user', 'to_user') if (a, b) in wanted]
+        if accepted:
+            FriendshipInvitation.objects.filter(pk__in=accepted).update(status='5')
+        
+        Contact.objects.add_friends(wanted)
+        
+        friends_cache.bump_version(*user_ids)
+        for friendship in new:
+            friends_graph.edge_added(friendship.from_user_id, friendship.to_user_id)
+        return len(new)
     
     def remove(self, user1, user2):
         self.filter(from_user=user1, to_user=user2).delete()
         self.filter(from_user=user2, to_user=user1).delete()
+        friends_cache.bump_version(user1, user2)
 
 
 HOW_RELATED_LABELS = {
@@ -295,10 +708,13 @@ class Friendship(models.Model):
         return self.render_related(you=True)
 
     def save(self, *args, **kwargs):
-        matching_fs = FriendSuggestion.objects.filter(suggested_user=self.to_user, user=self.from_user) | FriendSuggestion.objects.filter(suggested_user=self.from_user, user=self.to_user)
-        matching_fs.delete()
-        matching_fis = FriendshipInvitation.objects.filter(from_user=self.from_user, to_user=self.to_user) | FriendshipInvitation.objects.filter(from_user=self.to_user, to_user=self.from_user)
-        matching_fis.update(status='5')
+        if self.pk is None:
+            # new friendships go through befriend, which also creates the
+            # reverse direction and does the related bookkeeping
+            friendship, created = Friendship.objects.befriend(self.from_user, self.to_user, self.how_related)
+            self.pk = friendship.pk
+            self.added = friendship.added
+            return
         super(Friendship, self).save(*args, **kwargs)
 
     def render_related(self, you=False):
@@ -353,19 +769,45 @@ class Friendship(models.Model):
             result+= " (%s)" % self.how_related
         return result
 
-def friendship_symmetrical(sender, instance, created, *args, **kwargs):
-    if created:
-        try:
-            Friendship.objects.get(to_user=instance.from_user, from_user=instance.to_user)
-        except Friendship.DoesNotExist:
-            symmetrical_friendship = Friendship(to_user=instance.from_user, from_user=instance.to_user)
-            symmetrical_friendship.how_related=instance.how_related
-            symmetrical_friendship.added=instance.added
-            symmetrical_friendship.save()
-signals.post_save.connect(friendship_symmetrical, sender=Friendship)
-
 def friend_set_for(user):
-    return set([obj["friend"] for obj in Friendship.objects.friends_for_user(user)])
+    return set(Friendship.objects.friend_users_for_user(user))
+
+NOTIFY_BATCH_SIZE = getattr(settings, "FRIENDS_NOTIFY_BATCH_SIZE", 200)
+QUEUE_NOTIFICATIONS = getattr(settings, "FRIENDS_QUEUE_NOTIFICATIONS", False)
+
+def notify_friends_of(user1, user2, label, extra_context):
+    """
+    Sends the ``label`` notice to everyone who is a friend of either user,
+    except the two users themselves. The recipients come from the cached
+    friend IDs and are loaded and notified NOTIFY_BATCH_SIZE at a time; with
+    FRIENDS_QUEUE_NOTIFICATIONS the batches go to ``notification.queue`` to
+    be sent later by the ``emit_notices`` command.
+    
+    Returns the number of recipients.
+    """
+    if not notification:
+        return 0
+    recipient_ids = set(Friendship.objects.friend_ids_for_user(user1))
+    recipient_ids.update(Friendship.objects.friend_ids_for_user(user2))
+    recipient_ids.discard(user1.pk)
+    recipient_ids.discard(user2.pk)
+    if QUEUE_NOTIFICATIONS:
+        send = notification.queue
+    else:
+        send = notification.send
+    for batch in chunked(sorted(recipient_ids), NOTIFY_BATCH_SIZE):
+        send(list(User.objects.filter(pk__in=batch)), label, extra_context)
+    return len(recipient_ids)
+
+def friendship_bumps_cache_version(sender, instance, *args, **kwargs):
+    friends_cache.bump_version(instance.from_user_id, instance.to_user_id)
+
+def friendship_added_to_graph(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        friends_graph.edge_added(instance.from_user_id, instance.to_user_id)
+
+def friendship_removed_from_graph(sender, instance, *args, **kwargs):
+    friends_graph.edge_removed(instance.from_user_id, instance.to_user_id)
 
 
 INVITE_STATUS = (
@@ -382,7 +824,16 @@ INVITE_STATUS = (
 
 class JoinInvitationManager(models.Manager):
     
-    def send_invitation(self, from_user, to_email, message=None):
+    def send_invitation(self, from_user, to_email, message=None, deliver=True):
+        """
+        Creates an invitation and queues its email in the outbox. Unless
+        ``deliver`` is False or FRIENDS_QUEUE_INVITATIONS is set, the email
+        is sent straight away, and the invitation fails if it can't be;
+        queued emails are left to send_queued_invitations, which must then
+        be scheduled. Callers inviting several addresses should
+        pass deliver=False and hand the queued messages to
+        ``OutboxMessage.objects.deliver`` so they share one connection.
+        """
         contact, _ = Contact.objects.get_or_create(email=to_email, owner=from_user)
         contact.type = 'I'
         contact.save()
@@ -403,11 +854,14 @@ class JoinInvitationManager(models.Manager):
             "accept_url": accept_url,
         }
         
-        subject = render_to_string("friends/join_invite_subject.txt", ctx)
+        subject = "".join(render_to_string("friends/join_invite_subject.txt", ctx).splitlines())
         email_message = render_to_string("friends/join_invite_message.txt", ctx)
         
-        send_mail(subject, email_message, settings.DEFAULT_FROM_EMAIL, [to_email])        
-        return self.create(from_user=from_user, contact=contact, message=message, status="2", confirmation_key=confirmation_key)
+        invitation = self.create(from_user=from_user, contact=contact, message=message, status="1", confirmation_key=confirmation_key)
+        outgoing = OutboxMessage.objects.create(invitation=invitation, to_email=to_email, subject=subject, body=email_message)
+        if deliver and not QUEUE_INVITATIONS:
+            OutboxMessage.objects.deliver([outgoing], retry=False)
+        return invitation
 
 
 class JoinInvitation(models.Model):
@@ -430,22 +884,121 @@ class JoinInvitation(models.Model):
         self.status = "5"
         self.save()
         # auto-create friendship
-        friendship = Friendship(to_user=new_user, from_user=self.from_user)
-        friendship.save()
+        Friendship.objects.befriend(self.from_user, new_user)
         # notify
         if notification:
             notification.send([self.from_user], "join_accept", {"invitation": self, "new_user": new_user, "current_site": Site.objects.get_current()})
-            friends = []
-            for user in friend_set_for(new_user) | friend_set_for(self.from_user):
-                if user != new_user and user != self.from_user:
-                    friends.append(user)
             if notify_friends:
-                notification.send(friends, "friends_otherconnect", {"invitation": self, "to_user": new_user, "curent_site": Site.objects.get_current()})
+                notify_friends_of(new_user, self.from_user, "friends_otherconnect", {"invitation": self, "to_user": new_user, "curent_site": Site.objects.get_current()})
     
     class Meta:
         ordering=['-sent']
 
 
+OUTBOX_STATUS = (
+    ("1", "Queued"),
+    ("2", "Sent"),
+    ("3", "Failed"),
+    ("4", "Sending"),
+)
+QUEUE_INVITATIONS = getattr(settings, "FRIENDS_QUEUE_INVITATIONS", False)
+MAX_DELIVERY_ATTEMPTS = getattr(settings, "FRIENDS_MAX_DELIVERY_ATTEMPTS", 3)
+
+class OutboxMessageManager(models.Manager):
+    
+    def pending(self):
+        return self.filter(status="1").order_by('created')
+    
+    def claim(self, message):
+        """
+        Marks a queued message as being sent. Returns False if another
+        worker got to it first.
+        """
+        return self.filter(pk=message.pk, status="1").update(status="4") == 1
+    
+    def deliver(self, messages=None, connection=None, retry=True):
+        """
+        Sends the given outbox messages, or every pending one, over a single
+        mail connection and updates the message and invitation statuses in
+        bulk. Each message is claimed first, so messages another worker is
+        already sending are skipped. Messages that fail are queued again
+        for later calls until they reach MAX_DELIVERY_ATTEMPTS, when their
+        invitation is marked "Failed". With ``retry`` False, as when sending
+        inline without the send_queued_invitations command, they fail at
+        once.
+        
+        Returns a tuple of (number sent, number failed).
+        """
+        if messages is None:
+            messages = list(self.pending())
+        messages = [message for message in messages if self.claim(message)]
+        if not messages:
+            return 0, 0
+        connection = connection or get_connection()
+        sent = []
+        failed = []
+        try:
+            connection.open()
+        except Exception, inst:
+            # nothing can be sent; count it as a failed attempt for each message
+            for message in messages:
+                message.last_error = "%s" % inst
+            failed = list(messages)
+        else:
+            try:
+                for message in messages:
+                    try:
+                        connection.send_messages([message.email_message(connection)])
+                        sent.append(message)
+                    except Exception, inst:
+                        message.last_error = "%s" % inst
+                        failed.append(message)
+            finally:
+                connection.close()
+        if sent:
+            self.filter(pk__in=[m.pk for m in sent]).update(status="2", sent=datetime.datetime.now())
+            # leave invitations that were accepted in the meantime alone
+            JoinInvitation.objects.filter(pk__in=[m.invitation_id for m in sent], status="1").update(status="2")
+        given_up = []
+        for message in failed:
+            message.attempts += 1
+            if message.attempts >= MAX_DELIVERY_ATTEMPTS or not retry:
+                message.status = "3"
+                given_up.append(message.invitation_id)
+            else:
+                message.status = "1"
+            message.save()
+        if given_up:
+            JoinInvitation.objects.filter(pk__in=given_up, status="1").update(status="3")
+        return len(sent), len(failed)
+
+
+class OutboxMessage(models.Model):
+    """
+    An invitation email waiting to be sent, so that invitations can be
+    delivered in batches over one connection rather than inside the request
+    that created them.
+    """
+    
+    invitation = models.ForeignKey(JoinInvitation, related_name="outbox")
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=1, choices=OUTBOX_STATUS, default="1")
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(default=datetime.datetime.now, editable=False)
+    sent = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    objects = OutboxMessageManager()
+    
+    def email_message(self, connection=None):
+        return EmailMessage(self.subject, self.body, settings.DEFAULT_FROM_EMAIL, [self.to_email], connection=connection)
+    
+    def __unicode__(self):
+        return "%s to %s (%s)" % (self.subject, self.to_email, self.get_status_display())
+
+
 class FriendshipInvitationManager(models.Manager):
 
     def active(self, *args, **kwargs):
@@ -472,17 +1025,14 @@ class FriendshipInvitation(models.Model):
     
     def accept(self, notify_friends=False):
         if not Friendship.objects.are_friends(self.to_user, self.from_user):
-            friendship = Friendship(to_user=self.to_user, from_user=self.from_user, how_related=self.how_related)
-            friendship.save()
+            Friendship.objects.befriend(self.from_user, self.to_user, self.how_related)
             self.status = "5"
             self.save()
             if notification:
                 notification.send([self.from_user], "friends_accept", {"invitation": self, "curent_site": Site.objects.get_current()})
                 notification.send([self.to_user], "friends_accept_sent", {"invitation": self, "curent_site": Site.objects.get_current()})
                 if notify_friends:
-                    for user in friend_set_for(self.to_user) | friend_set_for(self.from_user):
-                        if user != self.to_user and user != self.from_user:
-                            notification.send([user], "friends_otherconnect", {"invitation": self, "to_user": self.to_user, "curent_site": Site.objects.get_current()})
+                    notify_friends_of(self.to_user, self.from_user, "friends_otherconnect", {"invitation": self, "to_user": self.to_user, "curent_site": Site.objects.get_current()})
     
     def decline(self):
         if not Friendship.objects.are_friends(self.to_user, self.from_user):
@@ -544,8 +1094,11 @@ def friendship_invitation(sender, instance, **kwargs):
 # SIGNALS
 signals.pre_save.connect(friendship_invitation, sender=FriendshipInvitation)
 signals.post_save.connect(contact_update_user, sender=User)
+signals.post_save.connect(contact_update_search_tokens, sender=Contact)
 signals.post_save.connect(friendsuggestion_update_user, sender=User)
-signals.post_save.connect(contact_create_for_friendship, sender=Friendship)
-signals.post_save.connect(friendship_destroys_suggestions, sender=Friendship)
 signals.pre_delete.connect(delete_friendship, sender=Friendship)
+signals.post_save.connect(friendship_bumps_cache_version, sender=Friendship)
+signals.post_delete.connect(friendship_bumps_cache_version, sender=Friendship)
+signals.post_save.connect(friendship_added_to_graph, sender=Friendship)
+signals.post_delete.connect(friendship_removed_from_graph, sender=Friendship)
 signals.post_save.connect(suggest_friend_from_invite, sender=JoinInvitation)
@@ -0,0 +1 @@
+CREATE INDEX friends_contactsearchtoken_owner_token_like ON friends_contactsearchtoken (owner_id, token varchar_pattern_ops);
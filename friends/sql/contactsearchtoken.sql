@@ -0,0 +1 @@
+CREATE INDEX friends_contactsearchtoken_owner_token ON friends_contactsearchtoken (owner_id, token);
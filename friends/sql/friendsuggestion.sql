@@ -0,0 +1 @@
+CREATE INDEX friends_friendsuggestion_user_active_score ON friends_friendsuggestion (user_id, active, score DESC);
@@ -1,15 +1,18 @@
-from friends.utils import shared_friends as get_shared_friends
+from friends.utils import mutual_friend_count, mutual_friends_sample
 from django import template
 from django.core.urlresolvers import NoReverseMatch
 
 register = template.Library()
 
+SHARED_FRIENDS_SHOWN = 5
+
 def shared_friends(context):
     friend = context['user']
     request = context['request']
     return {
         'request': context['request'],
         'friend': friend,
-        'shared_friends': get_shared_friends(request.user, friend)
+        'shared_friends': mutual_friends_sample(request.user, friend, limit=SHARED_FRIENDS_SHOWN, request=request),
+        'shared_friends_count': mutual_friend_count(request.user, friend, request=request),
     }
 register.inclusion_tag('friends/shared_friends.inc', takes_context=True)(shared_friends)
@@ -0,0 +1,317 @@
+import datetime, shutil, tempfile
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.utils.unittest import skipUnless
+
+try:
+    import django_rendering
+except ImportError:
+    django_rendering = None
+
+try:
+    import vobject
+except ImportError:
+    vobject = None
+
+from friends.models import Friendship, FriendSuggestion, FriendshipInvitation, Contact, chunked, insert_batch_size
+from friends.models import SUGGEST_BECAUSE_FRIENDOFFRIEND, ImportJob, JoinInvitation, OutboxMessage, link_users
+from friends import cache as friends_cache, utils as friends_utils
+from friends.utils import build_friend_suggestions, degrees_of_separation, find_separation, frontier_adjacency, SEPARATION_UNKNOWN
+from friends.merge import merge_duplicates
+from friends.importer import import_contacts, bundle_files, iter_outlook_contacts, iter_vcard_contacts, vobject_card_values
+from friends.exporter import export, get_writer, iter_friends, JSONLinesWriter, OutlookCSVWriter
+
+
+def create_users(n, prefix="user"):
+    users = [User(username="%s%d" % (prefix, i), email="%s%d@example.com" % (prefix, i), password="!") for i in range(n)]
+    for batch in chunked(users, insert_batch_size(User)):
+        User.objects.bulk_create(batch)
+    return list(User.objects.filter(username__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+
+
+class BulkBefriendTest(TestCase):
+    def test_more_pairs_than_one_batch(self):
+        user_ids = create_users(700)
+        pairs = [(user_ids[i], user_ids[i + 1]) for i in range(len(user_ids) - 1)]
+        pairs.extend((user_ids[0], other) for other in user_ids[2:])
+        FriendSuggestion.objects.bulk_create([FriendSuggestion(user_id=a, suggested_user_id=b) for a, b in pairs[:300]])
+        FriendshipInvitation.objects.bulk_create([FriendshipInvitation(from_user_id=b, to_user_id=a, status='2') for a, b in pairs[:300]])
+
+        created = Friendship.objects.bulk_befriend(pairs)
+
+        self.assertEqual(created, 2 * len(pairs))
+        self.assertEqual(Friendship.objects.count(), 2 * len(pairs))
+        self.assertEqual(FriendSuggestion.objects.count(), 0)
+        self.assertEqual(FriendshipInvitation.objects.exclude(status='5').count(), 0)
+        self.assertEqual(Contact.objects.filter(owner=user_ids[0], type='F').count(), len(user_ids) - 1)
+        self.assertEqual(Friendship.objects.bulk_befriend(pairs), 0)
+
+    def test_links_existing_contacts(self):
+        user_ids = create_users(2)
+        contact = Contact.objects.create(owner_id=user_ids[0], email="user1@example.com", type='A')
+
+        Friendship.objects.bulk_befriend([(user_ids[0], user_ids[1])])
+
+        contact = Contact.objects.get(pk=contact.pk)
+        self.assertEqual((contact.user_id, contact.type), (user_ids[1], 'F'))
+        self.assertEqual(Contact.objects.filter(owner=user_ids[0]).count(), 1)
+
+
+class BefriendTest(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create(username="alice", email="alice@example.com")
+        self.user2 = User.objects.create(username="bob", email="bob@example.com")
+
+    def test_half_existing_pair(self):
+        Friendship.objects.bulk_create([Friendship(from_user=self.user1, to_user=self.user2)])
+
+        friendship, created = Friendship.objects.befriend(self.user1, self.user2)
+
+        self.assertTrue(created)
+        self.assertEqual((friendship.from_user_id, friendship.to_user_id), (self.user1.pk, self.user2.pk))
+        self.assertTrue(Friendship.objects.filter(from_user=self.user2, to_user=self.user1).exists())
+        self.assertEqual(Friendship.objects.count(), 2)
+
+    def test_are_friends_fills_cache(self):
+        Friendship.objects.befriend(self.user1, self.user2)
+        cache.clear()
+
+        self.assertTrue(Friendship.objects.are_friends(self.user1, self.user2))
+        self.assertNumQueries(0, Friendship.objects.are_friends, self.user1, self.user2)
+
+
+class BuildFriendSuggestionsTest(TestCase):
+    def test_reactivates_suggestion_whose_reason_applies_again(self):
+        user_ids = create_users(3)
+        Friendship.objects.bulk_befriend([(user_ids[0], user_ids[1]), (user_ids[1], user_ids[2])])
+        suggestion = FriendSuggestion.objects.create(user_id=user_ids[0], suggested_user_id=user_ids[2],
+            why=SUGGEST_BECAUSE_FRIENDOFFRIEND, active=False)
+
+        created, deactivated = build_friend_suggestions(User.objects.get(pk=user_ids[0]))
+
+        self.assertEqual((created, deactivated), (0, 0))
+        suggestion = FriendSuggestion.objects.get(pk=suggestion.pk)
+        self.assertTrue(suggestion.active)
+        self.assertEqual(suggestion.score, 1)
+
+
+class ImportMergeTest(TestCase):
+    def test_merges_only_duplicates_of_imported_contacts(self):
+        owner = User.objects.create(username="owner", email="owner@example.com")
+        jane = Contact.objects.create(owner=owner, email="jane@example.com", first_name="Jane", last_name="Doe", phone="555 123 4567", type='A')
+        for email in ("bob@example.com", "bob@example.org"):
+            Contact.objects.create(owner=owner, email=email, first_name="Bob", last_name="Roe", phone="555 765 4321", type='A')
+
+        imported, total = import_contacts([{'email': 'jane@example.net', 'first_name': 'Jane', 'last_name': 'Doe', 'phone': '(555) 123-4567'}], owner, 'O')
+
+        self.assertEqual((imported, total), (1, 1))
+        self.assertEqual(list(Contact.objects.filter(owner=owner, last_name="Doe").values_list('pk', flat=True)), [jane.pk])
+        self.assertEqual(Contact.objects.filter(owner=owner, last_name="Roe").count(), 2)
+
+
+class GetWriterTest(TestCase):
+    def test_configured_writer(self):
+        with self.settings(FRIENDS_EXPORT_WRITERS={'ndjson': 'friends.exporter.JSONLinesWriter'}):
+            self.assertTrue(isinstance(get_writer('ndjson'), JSONLinesWriter))
+
+    def test_bad_writer_path(self):
+        with self.settings(FRIENDS_EXPORT_WRITERS={'ndjson': 'friends.exporter.MissingWriter'}):
+            self.assertRaises(ImproperlyConfigured, get_writer, 'ndjson')
+
+    def test_unknown_format(self):
+        self.assertRaises(KeyError, get_writer, 'xml')
+
+
+class IterFriendsTest(TestCase):
+    def test_ordered_across_batches(self):
+        user_ids = create_users(7)
+        for pk, (first_name, last_name) in zip(user_ids[1:], [("Bo", "Zed"), ("Al", "Ann"), ("Cy", "Moe"), ("Al", "Moe"), ("Di", "Bee"), ("Ed", "Ann")]):
+            User.objects.filter(pk=pk).update(first_name=first_name, last_name=last_name)
+        Friendship.objects.bulk_befriend((user_ids[0], other) for other in user_ids[1:])
+
+        friends = iter_friends(User.objects.get(pk=user_ids[0]), batch_size=2)
+
+        self.assertEqual([(f.last_name, f.first_name) for f in friends],
+            [("Ann", "Al"), ("Ann", "Ed"), ("Bee", "Di"), ("Moe", "Al"), ("Moe", "Cy"), ("Zed", "Bo")])
+
+
+VCARD = "BEGIN:VCARD\r\nVERSION:3.0\r\nN:Doe;Jane;;;\r\nFN:Jane Doe\r\nEMAIL:jane@example.com\r\nEND:VCARD\r\n"
+OUTLOOK = '"First Name","Last Name","E-mail Address"\r\n"John","Roe","john@example.com"\r\n'
+
+
+class MultipleFileImportTest(TestCase):
+    urls = 'friendsdev.bench_urls'
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.user = User.objects.create_user("uploader", "uploader@example.com", "secret")
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def uploads(self):
+        return [SimpleUploadedFile("jane.vcf", VCARD), SimpleUploadedFile("john.csv", OUTLOOK)]
+
+    def test_bundle_can_be_saved_on_a_job(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            job = ImportJob(owner=self.user, type='M')
+            job.contacts_file.save('contacts.zip', bundle_files(self.uploads()))
+
+            self.assertEqual(ImportJob.objects.get(pk=job.pk).contacts_file.size, job.contacts_file.size)
+
+    @skipUnless(django_rendering, "django_rendering is not installed")
+    def test_two_files_make_one_job(self):
+        self.client.login(username="uploader", password="secret")
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.client.post('/friends/import/file/', {'contacts_file': self.uploads()})
+
+        self.assertEqual(list(ImportJob.objects.values_list('owner', 'type')), [(self.user.pk, 'M')])
+
+
+class LinkUsersTest(TestCase):
+    def test_links_only_matching_rows(self):
+        owner = User.objects.create(username="owner", email="owner@example.com")
+        match = Contact.objects.create(owner=owner, email="New.User@Example.com", type='A')
+        other = Contact.objects.create(owner=owner, email="someone@example.com", type='A')
+        suggestion = FriendSuggestion.objects.create(email="new.user@example.com", suggested_user=owner)
+        new_user = User(username="new", email="new.user@example.com")
+        User.objects.bulk_create([new_user])
+        new_user = User.objects.get(username="new")
+
+        self.assertEqual(link_users([new_user.pk]), (1, 1))
+        self.assertEqual(Contact.objects.get(pk=match.pk).user_id, new_user.pk)
+        self.assertEqual(Contact.objects.get(pk=other.pk).user_id, None)
+        self.assertEqual(FriendSuggestion.objects.get(pk=suggestion.pk).user_id, new_user.pk)
+
+
+class SeparationTest(TestCase):
+    def setUp(self):
+        self.user_ids = create_users(5)
+        Friendship.objects.bulk_befriend(zip(self.user_ids, self.user_ids[1:]))
+        cache.clear()
+
+    def test_path(self):
+        self.assertEqual(find_separation(self.user_ids[0], self.user_ids[4]), (4, self.user_ids))
+
+    def test_aborted_search_is_unknown_and_not_cached(self):
+        me, them = User.objects.get(pk=self.user_ids[0]), User.objects.get(pk=self.user_ids[4])
+        friends_utils.find_separation = lambda me_id, them_id: find_separation(me_id, them_id, max_nodes=3)
+        try:
+            self.assertEqual(degrees_of_separation(me, them), SEPARATION_UNKNOWN)
+        finally:
+            friends_utils.find_separation = find_separation
+        self.assertEqual(friends_cache.get_separation(me, them), None)
+        self.assertEqual(degrees_of_separation(me, them)[0], 4)
+
+    def test_frontier_caches_friend_ids(self):
+        frontier_adjacency(self.user_ids[1:3])
+        self.assertNumQueries(0, frontier_adjacency, self.user_ids[1:3])
+        self.assertEqual(list(friends_cache.get_friend_ids(self.user_ids[1])), [self.user_ids[0], self.user_ids[2]])
+
+
+class BrokenConnection(object):
+    def open(self):
+        raise IOError("connection refused")
+
+
+class OutboxDeliveryTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username="owner", email="owner@example.com")
+        contact = Contact.objects.create(owner=owner, email="friend@example.com", type='I')
+        self.invitation = JoinInvitation.objects.create(from_user=owner, contact=contact, status="1", confirmation_key="key")
+        self.message = OutboxMessage.objects.create(invitation=self.invitation, to_email="friend@example.com", subject="Hi", body="Join")
+
+    def test_claimed_message_is_not_sent_twice(self):
+        stale = OutboxMessage.objects.get(pk=self.message.pk)
+        self.assertEqual(OutboxMessage.objects.deliver([self.message]), (1, 0))
+        self.assertEqual(OutboxMessage.objects.deliver([stale]), (0, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(JoinInvitation.objects.get(pk=self.invitation.pk).status, "2")
+
+    def test_failed_message_is_queued_again(self):
+        self.assertEqual(OutboxMessage.objects.deliver([self.message], BrokenConnection()), (0, 1))
+        message = OutboxMessage.objects.get(pk=self.message.pk)
+        self.assertEqual((message.status, message.attempts), ("1", 1))
+
+    def test_failed_inline_message_fails_its_invitation(self):
+        OutboxMessage.objects.deliver([self.message], BrokenConnection(), retry=False)
+        self.assertEqual(OutboxMessage.objects.get(pk=self.message.pk).status, "3")
+        self.assertEqual(JoinInvitation.objects.get(pk=self.invitation.pk).status, "3")
+
+
+FOLDED_VCARD = ("BEGIN:VCARD\r\nVERSION:3.0\r\nN:Lovelace;Augusta Ada;;;\r\nFN:Augusta Ada King\\, Countess of Lo\r\n"
+    " velace\r\nEMAIL;TYPE=INTERNET:ada@exam\r\n\tple.com\r\nEND:VCARD\r\n")
+QP_VCARD = ("BEGIN:VCARD\r\nVERSION:2.1\r\nN;CHARSET=ISO-8859-1;ENCODING=QUOTED-PRINTABLE:M=FCller;J=FCrgen\r\n"
+    "FN;CHARSET=ISO-8859-1;ENCODING=QUOTED-PRINTABLE:J=FCrgen =\r\nM=FCller\r\nEMAIL;INTERNET:juergen@example.com\r\nEND:VCARD\r\n")
+PREF_VCARD = ("BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Grace Hopper\r\nEMAIL;TYPE=INTERNET:grace@example.com\r\n"
+    "EMAIL;TYPE=INTERNET,PREF:hopper@example.com\r\nEND:VCARD\r\n")
+PREF4_VCARD = ("BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Grace Hopper\r\nEMAIL;PREF=2:grace@example.com\r\n"
+    "EMAIL;PREF=1:hopper@example.com\r\nEMAIL:navy@example.com\r\nEND:VCARD\r\n")
+
+
+@skipUnless(vobject, "vobject is not installed")
+class NativeVCardParserTest(TestCase):
+    def assertMatchesVobject(self, card):
+        native = list(iter_vcard_contacts(card))[0]
+        fallback = vobject_card_values(vobject.readOne(card, allowQP=True))
+        for field, value in fallback.items():
+            self.assertEqual(native[field].decode('utf-8'), value)
+        return native
+
+    def test_folded_lines(self):
+        native = self.assertMatchesVobject(FOLDED_VCARD)
+        self.assertEqual(native['name'], "Augusta Ada King, Countess of Lovelace")
+        self.assertEqual(native['email'], "ada@example.com")
+
+    def test_quoted_printable_with_charset(self):
+        native = self.assertMatchesVobject(QP_VCARD)
+        self.assertEqual(native['name'].decode('utf-8'), u"J\xfcrgen M\xfcller")
+        self.assertEqual(native['last_name'].decode('utf-8'), u"M\xfcller")
+
+    def test_preferred_email(self):
+        card = vobject.readOne(PREF_VCARD)
+        preferred = [e.value for e in card.contents['email'] if 'PREF' in e.params.get('TYPE', [])]
+        self.assertEqual([c['email'] for c in iter_vcard_contacts(PREF_VCARD)], preferred)
+
+    def test_vcard4_pref_parameter(self):
+        self.assertEqual([c['email'] for c in iter_vcard_contacts(PREF4_VCARD)], ["hopper@example.com"])
+
+
+class OutlookRoundTripTest(TestCase):
+    def test_every_exported_column_is_read_back(self):
+        values = {
+            'name': 'Grace Hopper', 'first_name': 'Grace', 'last_name': 'Hopper', 'email': 'grace@example.com',
+            'phone': '+1 555 0100', 'mobile': '+1 555 0101', 'fax': '+1 555 0102', 'address': '1 Navy Way, Arlington, VA',
+            'website': 'http://example.com/', 'birthday': datetime.date(1906, 12, 9),
+        }
+        exported = ''.join(export(OutlookCSVWriter(), [values]))
+
+        self.assertEqual(list(iter_outlook_contacts(exported)), [values])
+
+
+class FriendshipContactMergeTest(TestCase):
+    def setUp(self):
+        self.owner, self.friend = [User.objects.get(pk=pk) for pk in create_users(2)]
+
+    def test_merge_keeps_friendship_contacts(self):
+        Friendship.objects.befriend(self.owner, self.friend)
+        contact = Contact.objects.get(owner=self.owner, user=self.friend)
+        Contact.objects.create(owner=self.owner, email="USER1@example.com", type='F', user=self.friend)
+
+        merge_duplicates(self.owner)
+
+        self.assertEqual(Contact.objects.filter(owner=self.owner, type='F').count(), 2)
+        self.assertEqual(Contact.objects.get(pk=contact.pk).deleted, None)
+
+    def test_befriend_undeletes_contact(self):
+        contact = Contact.objects.create(owner=self.owner, email=self.friend.email, type='O', deleted=datetime.date.today())
+
+        Friendship.objects.befriend(self.owner, self.friend)
+
+        contact = Contact.objects.get(pk=contact.pk)
+        self.assertEqual((contact.deleted, contact.type, contact.user_id), (None, 'F', self.friend.pk))
@@ -20,6 +20,10 @@ urlpatterns = patterns('',
    url(r'^addressbook/$', addressbook, name="edit_contacts"),
    url(r'^import/file/$', import_file_contacts, name="import_file_contacts"),
    url(r'^import/google/$', import_google_contacts, name="import_google_contacts"),
+   url(r'^import/status/(?P<job_id>[0-9]+)/$', import_status, name="import_status"),
+   url(r'^export/$', export_friends, name="export_friends"),
+   url(r'^export/(?P<format>[a-z]+)/$', export_friends, name="export_friends_as"),
+   url(r'^export/contacts/(?P<format>[a-z]+)/$', export_contacts, name="export_contacts"),
    url(r'^(?P<user>[-\w\.]+)/$', view_friends, name="view_friends"),
    url(r'^$', edit_friends, name="edit_friends"),
 )
@@ -1,5 +1,12 @@
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, SiteProfileNotAvailable
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Count, get_model
+import time
+from collections import defaultdict
+from friends import cache as friends_cache
+from friends.graph import get_graph
 from models import *
+from models import BULK_BATCH_SIZE, QUEUE_INVITATIONS, chunked, insert_batch_size
 
 from django.conf import settings
 if "notification" in settings.INSTALLED_APPS:
@@ -8,45 +15,257 @@ else:
     notification = None
 
 
-def build_friend_suggestions(user, *args, **kwargs):
-    profile = user.get_profile()
-    friend_suggestions_users = [fs.suggested_user for fs in FriendSuggestion.objects.select_related('suggested_user__id').filter(user=user)]
+MAX_NEIGHBORS = 100 # Don't add them as suggestions if you're in an area with a ton of people.
+
+def get_profile_for(user):
     try:
-        coworkers = profile.get_coworkers().exclude(user__in=friend_suggestions_users).exclude(user=user)
-        for coworker in coworkers:
-            try:
-                FriendSuggestion.objects.get(user=user, suggested_user=coworker.user)
-            except FriendSuggestion.DoesNotExist:
-                FriendSuggestion(user=user, suggested_user=coworker.user, why=SUGGEST_BECAUSE_COWORKER).save()
-    except AttributeError, inst:
-        print inst
+        return user.get_profile()
+    except (AttributeError, ObjectDoesNotExist, SiteProfileNotAvailable):
+        return None
+
+def suggestion_candidates(user, profile=None, mutual_counts=None):
+    """
+    Returns a dict of suggested user id -> reason for everyone who could be
+    suggested to ``user``, and the set of reasons that were actually
+    computed. Each reason costs one query; the first reason found for a
+    candidate wins, in the order coworker, friend of friend, neighbor.
+    Pass ``mutual_counts`` if mutual_friend_counts(user) is already known.
+    """
+    if profile is None:
+        profile = get_profile_for(user)
+    if mutual_counts is None:
+        mutual_counts = mutual_friend_counts(user)
+    candidates = {}
+    computed = set()
+    try:
+        coworkers = profile.get_coworkers().exclude(user=user)
+        for candidate_id in coworkers.values_list('user', flat=True):
+            candidates.setdefault(candidate_id, SUGGEST_BECAUSE_COWORKER)
+        computed.add(SUGGEST_BECAUSE_COWORKER)
+    except AttributeError:
         pass
-    for fof in friends_of_friends(user).exclude(id__in=[u.id for u in friend_suggestions_users]):
-            try:
-                FriendSuggestion.objects.get(user=user, suggested_user=fof)
-            except FriendSuggestion.DoesNotExist:
-                FriendSuggestion(user=user, suggested_user=fof, why=SUGGEST_BECAUSE_FRIENDOFFRIEND).save()
+    for candidate_id in mutual_counts:
+        candidates.setdefault(candidate_id, SUGGEST_BECAUSE_FRIENDOFFRIEND)
+    computed.add(SUGGEST_BECAUSE_FRIENDOFFRIEND)
     try:
-        neighbors = profile.get_neighbors().exclude(user__in=friend_suggestions_users).exclude(user=user)
-        MAX_NEIGHBORS = 100 # Don't add them as suggestions if you're in an area with a ton of people.
-        if neighbors.count() < MAX_NEIGHBORS:
-            for neighbor in neighbors:
-                try:
-                    FriendSuggestion.objects.get(user=user, suggested_user=neighbor.user)
-                except FriendSuggestion.DoesNotExist:
-                    FriendSuggestion(user=user, suggested_user=neighbor.user, why=SUGGEST_BECAUSE_NEIGHBOR).save()
-    except AttributeError, inst:
-        print inst
-        pass        
-
-def shared_friends(me, them):
-    my_friends = User.objects.filter(friends__to_user=me)
-    their_friends = User.objects.filter(friends__to_user=them)
-    shared_friends = my_friends & their_friends
-    return shared_friends.exclude(id__in=[me.id, them.id])
+        neighbors = list(profile.get_neighbors().exclude(user=user).values_list('user', flat=True)[:MAX_NEIGHBORS])
+        if len(neighbors) < MAX_NEIGHBORS:
+            for candidate_id in neighbors:
+                candidates.setdefault(candidate_id, SUGGEST_BECAUSE_NEIGHBOR)
+        computed.add(SUGGEST_BECAUSE_NEIGHBOR)
+    except AttributeError:
+        pass
+    for friend_id in Friendship.objects.friend_ids_for_user(user):
+        candidates.pop(friend_id, None)
+    candidates.pop(user.pk, None)
+    return candidates, computed
+
+def build_friend_suggestions(user, *args, **kwargs):
+    """
+    Brings the suggestions for ``user`` in line with the current candidates:
+    new candidates are inserted with bulk_create, active suggestions whose
+    reason no longer applies are deactivated in a single update and
+    inactive ones whose reason applies again are reactivated in another.
+    Returns a tuple of (number created, number deactivated).
+    """
+    scores = mutual_friend_counts(user)
+    candidates, computed = suggestion_candidates(user, mutual_counts=scores)
+    rows = list(FriendSuggestion.objects.filter(user=user).values_list('pk', 'suggested_user', 'why', 'active', 'score'))
+    existing = {}
+    shown = set(suggested_id for pk, suggested_id, why, active, score in rows if active)
+    stale = []
+    reactivated = []
+    rescored = defaultdict(list)
+    for pk, suggested_id, why, active, score in rows:
+        existing.setdefault(suggested_id, why)
+        if active and why in computed and candidates.get(suggested_id) != why:
+            stale.append(pk)
+            continue
+        if not active:
+            if suggested_id in shown or candidates.get(suggested_id) != why:
+                continue
+            shown.add(suggested_id)
+            reactivated.append(pk)
+        if scores.get(suggested_id, 0) != score:
+            rescored[scores.get(suggested_id, 0)].append(pk)
+    new_suggestions = [
+        FriendSuggestion(user_id=user.pk, suggested_user_id=suggested_id, why=why, score=scores.get(suggested_id, 0))
+        for suggested_id, why in candidates.items() if suggested_id not in existing
+    ]
+    for batch in chunked(new_suggestions, insert_batch_size(FriendSuggestion)):
+        FriendSuggestion.objects.bulk_create(batch)
+    for batch in chunked(stale, BULK_BATCH_SIZE):
+        FriendSuggestion.objects.filter(pk__in=batch).update(active=False)
+    for batch in chunked(reactivated, BULK_BATCH_SIZE):
+        FriendSuggestion.objects.filter(pk__in=batch).update(active=True)
+    # one update per distinct score rather than one per suggestion
+    for score, pks in rescored.items():
+        for batch in chunked(pks, BULK_BATCH_SIZE):
+            FriendSuggestion.objects.filter(pk__in=batch).update(score=score)
+    return len(new_suggestions), len(stale)
+
+MUTUAL_FRIENDS_SAMPLE = 10
+
+def mutual_friend_ids(me, them, request=None):
+    """
+    Returns the set of IDs of users who are friends with both ``me`` and
+    ``them`` by intersecting their cached friend IDs. When ``request`` is
+    given the result is memoized on it, so a page asking about the same
+    pair several times only computes it once.
+    """
+    key = tuple(sorted([me.pk, them.pk]))
+    if request is not None:
+        memo = request.__dict__.setdefault('_mutual_friend_ids', {})
+        if key in memo:
+            return memo[key]
+    shared = set(Friendship.objects.friend_ids_for_user(me)).intersection(Friendship.objects.friend_ids_for_user(them))
+    shared.difference_update(key)
+    if request is not None:
+        memo[key] = shared
+    return shared
+
+def mutual_friend_count(me, them, request=None):
+    return len(mutual_friend_ids(me, them, request))
+
+def mutual_friends_sample(me, them, limit=MUTUAL_FRIENDS_SAMPLE, request=None):
+    """ Returns up to ``limit`` of the mutual friends as User objects, ordered by name """
+    shared = mutual_friend_ids(me, them, request)
+    if not shared:
+        return []
+    return list(User.objects.filter(pk__in=sorted(shared)[:limit]).order_by('last_name', 'first_name'))
+
+def shared_friends(me, them, request=None):
+    return User.objects.filter(pk__in=list(mutual_friend_ids(me, them, request)))
 
 def friends_of_friends(user):
-    return User.objects.filter(friends__to_user__friends__to_user=user).exclude(id=user.id).exclude(friends__to_user=user)
+    return User.objects.filter(friends__to_user__friends__to_user=user).exclude(id=user.id).exclude(friends__to_user=user).distinct()
+
+def mutual_friend_counts(user):
+    """
+    Returns a dict of user id -> number of mutual friends for everyone who
+    is a friend of one of the user's friends but not a friend of the user.
+    Read from the in-memory graph when FRIENDS_GRAPH_ENGINE is on, counted
+    in memory when every friend's adjacency list is cached, and otherwise
+    done with a single GROUP BY query.
+    """
+    graph = get_graph()
+    if graph is not None:
+        return graph.friends_of_friends(user.pk)
+    friend_ids = Friendship.objects.friend_ids_for_user(user)
+    if not friend_ids:
+        return {}
+    excluded = set(friend_ids)
+    excluded.add(user.pk)
+    adjacency = friends_cache.get_many_friend_ids(friend_ids)
+    if len(adjacency) == len(friend_ids):
+        counts = defaultdict(int)
+        for their_friends in adjacency.values():
+            for candidate_id in their_friends:
+                if candidate_id not in excluded:
+                    counts[candidate_id] += 1
+        return dict(counts)
+    my_friends = Friendship.objects.filter(from_user=user).values('to_user')
+    mutual = Friendship.objects.filter(from_user__in=my_friends).exclude(to_user__in=my_friends).exclude(to_user=user)
+    return dict(mutual.values_list('to_user').annotate(mutual=Count('pk')).order_by())
+
+SEPARATION_MAX_DEPTH = getattr(settings, "FRIENDS_SEPARATION_MAX_DEPTH", 6)
+SEPARATION_MAX_NODES = getattr(settings, "FRIENDS_SEPARATION_MAX_NODES", 20000)
+SEPARATION_TIME_BUDGET = getattr(settings, "FRIENDS_SEPARATION_TIME_BUDGET", 0.25) # seconds
+SEPARATION_UNKNOWN = (None, None) # the search hit its limits before finding an answer
+
+def frontier_adjacency(user_ids):
+    """
+    Returns a dict of user id -> friend IDs for a BFS frontier. Uses the
+    in-memory graph when it is on; otherwise reads the cached lists in one
+    round trip, loads the rest with one query per batch and caches them.
+    """
+    graph = get_graph()
+    if graph is not None:
+        return dict((user_id, graph.neighbors_of(user_id)) for user_id in user_ids)
+    adjacency, versions = friends_cache.lookup_many(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in adjacency]
+    for batch in chunked(missing, BULK_BATCH_SIZE):
+        loaded = dict((user_id, []) for user_id in batch)
+        for from_id, to_id in Friendship.objects.filter(from_user__in=batch).values_list('from_user', 'to_user'):
+            loaded[from_id].append(to_id)
+        adjacency.update(friends_cache.set_many_friend_ids(loaded, versions))
+    return adjacency
+
+def _walk_back(parents, user_id):
+    path = []
+    while user_id is not None:
+        path.append(user_id)
+        user_id = parents[user_id]
+    return path
+
+def find_separation(me_id, them_id, max_depth=SEPARATION_MAX_DEPTH, max_nodes=SEPARATION_MAX_NODES, time_budget=SEPARATION_TIME_BUDGET):
+    """
+    Bidirectional breadth-first search between two user IDs. Each step
+    expands the smaller of the two frontiers one whole level at a time.
+    Returns (distance, path of user IDs from ``me_id`` to ``them_id``),
+    (None, []) when there is no path within ``max_depth`` hops, or
+    SEPARATION_UNKNOWN when the search gave up after visiting ``max_nodes``
+    users or spending ``time_budget`` seconds.
+    """
+    if me_id == them_id:
+        return 0, [me_id]
+    deadline = time.time() + time_budget
+    parents = [{me_id: None}, {them_id: None}]
+    frontiers = [[me_id], [them_id]]
+    visited = 2
+    depth = 0
+    while frontiers[0] and frontiers[1] and depth < max_depth:
+        side = len(frontiers[0]) > len(frontiers[1]) and 1 or 0
+        here, there = parents[side], parents[1 - side]
+        next_frontier = []
+        for user_id, friend_ids in frontier_adjacency(frontiers[side]).items():
+            for friend_id in friend_ids:
+                friend_id = int(friend_id)
+                if friend_id in there:
+                    path = _walk_back(here, user_id)[::-1] + _walk_back(there, friend_id)
+                    if side:
+                        path.reverse()
+                    return len(path) - 1, path
+                if friend_id not in here:
+                    here[friend_id] = user_id
+                    next_frontier.append(friend_id)
+                    visited += 1
+                    # checked per user, since one level around a hub can be huge
+                    if visited > max_nodes or time.time() > deadline:
+                        return SEPARATION_UNKNOWN
+        frontiers[side] = next_frontier
+        depth += 1
+    return None, []
+
+def degrees_of_separation(me, them, request=None):
+    """
+    Returns (distance, list of users along one shortest path from ``me`` to
+    ``them``), (None, []) when they aren't connected within
+    SEPARATION_MAX_DEPTH hops, or SEPARATION_UNKNOWN when the search ran
+    out of nodes or time. Answers are cached per pair and memoized on
+    ``request``; unknown results are only memoized, so the next request
+    searches again.
+    """
+    key = (me.pk, them.pk)
+    if request is not None:
+        memo = request.__dict__.setdefault('_degrees_of_separation', {})
+        if key in memo:
+            return memo[key]
+    found = friends_cache.get_separation(me, them)
+    if found is None:
+        found = find_separation(me.pk, them.pk)
+        if found == SEPARATION_UNKNOWN:
+            if request is not None:
+                memo[key] = found
+            return found
+        friends_cache.set_separation(me, them, *found)
+    distance, path = found
+    users = User.objects.in_bulk(path[1:-1])
+    users.update({me.pk: me, them.pk: them})
+    result = distance, [users[user_id] for user_id in path if user_id in users]
+    if request is not None:
+        memo[key] = result
+    return result
 
 def send_invitations(me, invited_emails=[], message=None):
         processed_emails = []
@@ -55,10 +274,10 @@ def send_invitations(me, invited_emails=[], message=None):
         invitations = 0
         existing = 0
         total = len(invited_emails)
-        friend_users = [f['friend'] for f in Friendship.objects.friends_for_user(me)]
         if existing_users:
+            friend_ids = Friendship.objects.are_friends_many(me, [u.pk for u in existing_users])
             for user in existing_users:
-                if user in friend_users:
+                if user.pk in friend_ids:
                     existing += 1
                 else:
                     requests += 1
@@ -73,23 +292,34 @@ def send_invitations(me, invited_emails=[], message=None):
                     invited_emails.remove(user.email)
                 except:
                     pass #guess it was already gone?
+        queued = []
         for email in invited_emails:
             if email not in processed_emails:
                 processed_emails.append(email)
                 invitations += 1
-                JoinInvitation.objects.send_invitation(me, email, None)
+                queued.append(JoinInvitation.objects.send_invitation(me, email, None, deliver=False).pk)
+        if queued and not QUEUE_INVITATIONS:
+            # one mail connection for the whole form rather than one per address
+            OutboxMessage.objects.deliver(list(OutboxMessage.objects.pending().filter(invitation__in=queued)), retry=False)
         return total, requests, existing, invitations
 
+def get_profiles_for(users):
+    """
+    Loads the profiles of the given users in one query and primes each
+    user's get_profile() cache with them.
+    
+    Returns a dict of user id -> profile.
+    """
+    users = [u for u in users if u is not None]
+    if not users or not getattr(settings, 'AUTH_PROFILE_MODULE', None):
+        return {}
+    app_label, model_name = settings.AUTH_PROFILE_MODULE.split('.')
+    profile_model = get_model(app_label, model_name)
+    profiles = dict((p.user_id, p) for p in profile_model._default_manager.filter(user__in=[u.pk for u in users]))
+    for user in users:
+        if user.pk in profiles:
+            user._profile_cache = profiles[user.pk]
+    return profiles
+
 def get_friends(user=None):
-    if not hasattr(user, '_friends'):
-        friend_list = Friendship.objects.friends_for_user(user)
-        friend_users = {}
-        for u in User.objects.filter(pk__in=[f['friend'].pk for f in friend_list]):
-            friend_users[u.id]=u
-        already = []
-        user._friends = []
-        for f in friend_list:
-            if f['friend'] not in already:
-                user._friends.append(f)
-                already.append(f['friend'])
-    return user._friends
+    return Friendship.objects.friends_for_user(user)
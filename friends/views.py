@@ -1,7 +1,14 @@
 # Rendering & Requests
 from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponse, HttpResponseRedirect
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # before Django 1.5 HttpResponse still sends an iterator lazily, as long
+    # as no middleware reads response.content
+    StreamingHttpResponse = HttpResponse
 from django.shortcuts import get_object_or_404
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib import messages
 from django_rendering.decorators import render_to
 
@@ -29,10 +36,10 @@ else:
 # Locals (used only in Friends)
 from friends.models import *
 from friends.forms import MultipleInviteForm, InviteFriendForm, ImportContactForm, ContactForm, FriendshipForm
-from friends.exporter import export_vcards
-from friends.importer import import_vcards, import_outlook, import_google
+from friends.exporter import export, export_formats, get_writer, iter_contacts, iter_friend_values
+from friends.importer import detect_format, bundle_files, start_import_job
 from friends.signals import invite
-from friends.utils import shared_friends, get_friends
+from friends.utils import get_profiles_for, mutual_friend_count, mutual_friends_sample, degrees_of_separation
 
 
 def get_user_profile(user):
@@ -68,30 +75,28 @@ def view_friends(request, user, template_name="friends/friends.html", redirect_t
     except AttributeError:
         pass
     friends = Friendship.objects.friends_for_user(user)
+    if request.user.is_authenticated() and request.user != user:
+        separation, separation_path = degrees_of_separation(request.user, user, request=request)
     return locals(), template_name
 
 @render_to()
-def friend_lookup(request):
-    query_tokens = re.split(r'\W+',request.GET.get('q',''))
-    matching_friends = Contact.objects.all()
-    if query_tokens:
-        for token in query_tokens:
-            matching_friends = (
-                matching_friends.filter(name__icontains=token) |
-                matching_friends.filter(first_name__icontains=token) |
-                matching_friends.filter(last_name__icontains=token)
-            )
-    else:
-        matching_friends = []
+@login_required
+def friend_lookup(request, limit=20):
+    try:
+        limit = max(1, min(int(request.GET.get('limit', limit)), limit))
+    except ValueError:
+        pass
+    matching_friends = ContactSearchToken.objects.search(request.user, request.GET.get('q',''))
+    matching_friends = matching_friends.order_by('name', 'email').values('id', 'name', 'first_name', 'last_name', 'email', 'user')[:limit]
     results = []
     for friend in matching_friends:
         results.append({
-            'id':str(friend.id),
-            'name':str(friend.name),
-            'first_name':str(friend.first_name),
-            'last_name':str(friend.last_name),
-            'email':str(friend.email),
-            'user':str(friend.user.id),
+            'id':u"%s" % friend['id'],
+            'name':u"%s" % (friend['name'] or ''),
+            'first_name':u"%s" % (friend['first_name'] or ''),
+            'last_name':u"%s" % (friend['last_name'] or ''),
+            'email':u"%s" % friend['email'],
+            'user':u"%s" % (friend['user'] or ''),
         })
     return results
 
@@ -156,13 +161,15 @@ def add_friend(request, friend, template_name='friends/add_friend.html', add_for
     friend, friend_profile = get_user_profile(friend)
     
     # Check for friendship
-    if friend in [f.to_user for f in request.user.friends.all()]:
+    if Friendship.objects.are_friends(request.user, friend):
         messages.info(request, "You're already friends with %s." % (friend.get_full_name() or friend.username))
         if not redirect_to:
             redirect_to = reverse(settings.PROFILE_URL,args=[friend.username])
         return {'success':False}, {'url': redirect_to}
     
-    connections = shared_friends(request.user, friend)
+    connections = mutual_friends_sample(request.user, friend, limit=3, request=request)
+    connections_count = mutual_friend_count(request.user, friend, request=request)
+    separation, separation_path = degrees_of_separation(request.user, friend, request=request)
     redirect_to=request.REQUEST.get(REDIRECT_FIELD_NAME, redirect_to)
     if redirect_to and '/' not in redirect_to:
         redirect_to=reverse(redirect_to)
@@ -327,11 +334,21 @@ def remove_friend(request,friend,template_name='confirm.html',redirect_to='edit_
     return {}, {'url':redirect_to }
 
 
-def export_friends(request):
-    vcard = export_vcards([ec.friend.user for ec in get_friends(request.user)])
-    response = HttpResponse(vcard, mimetype='text/x-vcard')
-    response['Content-Disposition'] = 'attachment; filename=friends.vcf'
-    return response    
+def export_response(rows, format, filename):
+    if format not in export_formats():
+        raise Http404("Unknown export format: %s" % format)
+    writer = get_writer(format)
+    response = StreamingHttpResponse(export(writer, rows), content_type=writer.content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, writer.extension)
+    return response
+
+@login_required
+def export_friends(request, format='vcard'):
+    return export_response(iter_friend_values(request.user), format, 'friends')
+
+@login_required
+def export_contacts(request, format='vcard'):
+    return export_response(iter_contacts(Contact.objects.filter(owner=request.user)), format, 'contacts')
 
     
 @render_to()
@@ -343,39 +360,27 @@ def import_file_contacts(request, form_class=ImportContactForm, template_name='f
     if request.method == 'POST':
         contacts_file_form=form_class(request.POST,request.FILES)
         if contacts_file_form.is_valid():
-            friends_file=request.FILES['contacts_file']
-            if friends_file.multiple_chunks():
-                messages.add_message(request, messages.ERROR,"The file you uploaded is too large.")
+            uploads = request.FILES.getlist('contacts_file')
+            if len(uploads) > 1:
+                # several files travel together as one archive job
+                friends_file = bundle_files(uploads)
+                format = 'ZIP'
             else:
-                start = True
+                friends_file = uploads[0]
+                # only the first chunk is needed to tell the formats apart; the
+                # importers then stream the rest of the upload themselves
                 format = None
-                contact_file_content = ""
                 for chunk in friends_file.chunks():
-                    if start == True:
-                        if 'VCARD' in chunk:
-                            format = 'VCARD'
-                        else:
-                            ARBITRARY_FIELD_MINIMUM=5
-                            first_line = chunk.split('\n')[0]
-                            if len(first_line.split(',')) > ARBITRARY_FIELD_MINIMUM or len(first_line.split('\t')) > ARBITRARY_FIELD_MINIMUM:
-                                format = 'OUTLOOK' 
-                    contact_file_content += chunk
-                    start = False
-                if format == 'VCARD':
-                    imported, total = import_vcards(contact_file_content, request.user)
-                elif format == 'OUTLOOK':
-                    imported, total = import_outlook(contact_file_content, request.user)
-                if format:
-                    if imported < total:
-                        if imported:
-                            messages.add_message(request, messages.SUCCESS,'A total of %d emails imported. %d records were already imported.' % (imported, total-imported))
-                        else:
-                            messages.add_message(request, messages.SUCCESS,'A total of %d emails were found, but they were already imported.' % (total))
-                    else:
-                        messages.add_message(request, messages.SUCCESS,'A total of %d emails imported vs %d.' % (imported,total))
-                    return {'imported':imported, 'total':total}, {'url': redirect_to} 
-                else:
-                    messages.add_message(request, messages.ERROR,'The file format you uploaded wasn\'t valid.')
+                    format = detect_format(chunk)
+                    break
+            if format:
+                job = ImportJob(owner=request.user, type={'VCARD': 'V', 'OUTLOOK': 'O', 'ZIP': 'M'}[format])
+                job.contacts_file.save(friends_file.name, friends_file)
+                start_import_job(job)
+                messages.add_message(request, messages.SUCCESS,'Your contacts are being imported. They will appear below as they are added.')
+                return {'job':job.pk}, {'url': "%s?job=%d" % (redirect_to, job.pk)}
+            else:
+                messages.add_message(request, messages.ERROR,'The file format you uploaded wasn\'t valid.')
     else:
         contacts_file_form=form_class()
     return locals(), template_name
@@ -425,30 +430,24 @@ def import_google_contacts(request, redirect_to="invite_imported", redirect_fiel
             return HttpResponseRedirect(url)
 
     if token_for_user:
-        try:
-            imported, total = import_google(request.user)
-        except gdata.service.RequestError:
-            if not request.session.has_key('_try_again'):
-                request.session["_try_again"]="import_google_contacts"
-                GoogleToken.objects.filter(user=request.user).delete()
-                if request.session.has_key('request_token'):
-                    del(request.session['request_token'])
-                return HttpResponseRedirect(
-                                        "%s?%s" % (reverse('import_google_contacts'),
-                                        urllib.urlencode({ 
-                                        redirect_field_name: redirect_to})))
-            else:
-                del(request.session['_try_again'])
-                messages.add_message(request, messages.ERROR,"There was an error posting to Twitter. Please make sure this site isn't blocked in your settings in Twitter.")
-                return {}, {'url': redirect_to} 
-        if imported < total:
-            if imported:
-                messages.add_message(request, messages.SUCCESS,'A total of %d emails imported. %d records were already imported.' % (imported, total-imported))
-            else:
-                messages.add_message(request, messages.SUCCESS,'A total of %d emails were found, but they were already imported.' % (total))
-        else:
-            messages.add_message(request, messages.SUCCESS,'A total of %d emails imported vs %d.' % (imported,total))
-        return {'imported':imported, 'total':total}, {'url': redirect_to} 
+        job = ImportJob.objects.create(owner=request.user, type='G')
+        start_import_job(job)
+        messages.add_message(request, messages.SUCCESS,'Your Google contacts are being imported. They will appear below as they are added.')
+        return {'job':job.pk}, {'url': "%s?job=%d" % (redirect_to, job.pk)}
+
+
+@render_to()
+@login_required
+def import_status(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id, owner=request.user)
+    return {
+        'id': job.pk,
+        'status': job.get_status_display(),
+        'done': job.is_done(),
+        'imported': job.imported,
+        'total': job.total,
+        'error': job.error,
+    }
 
 
 @render_to()
@@ -460,7 +459,14 @@ def invite_imported(request, type=None):
     else:
         imported_contacts = imported_contacts.filter(type__in=[t[0] for t in IMPORTED_TYPES])
     imported_contacts = imported_contacts.order_by('name','email')
-    return {'contacts':imported_contacts }, 'friends/invite_imported.html'
+    job_id = request.REQUEST.get('job', '')
+    if job_id.isdigit():
+        jobs = ImportJob.objects.filter(owner=request.user, pk=job_id)
+    else:
+        jobs = ImportJob.objects.filter(owner=request.user, status__in=["1", "2"]).order_by('-created')
+    jobs = list(jobs[:1])
+    job = jobs and jobs[0] or None
+    return {'contacts':imported_contacts, 'job':job }, 'friends/invite_imported.html'
 
 
 @render_to()
@@ -531,9 +537,9 @@ def edit_friends(request, friend=None, redirect_to='edit_friends', form_class=Fr
         redirect_to=reverse(redirect_to)
     if friend:
         friend, friend_profile = get_user_profile(friend)
-        if Friendship.objects.are_friends(friend, request.user):
-            friendship, _ = Friendship.objects.get_or_create(from_user=request.user, to_user=friend)
-        else:
+        try:
+            friendship = Friendship.objects.get(from_user=request.user, to_user=friend)
+        except Friendship.DoesNotExist:
             messages.add_message(request, messages.ERROR,"%s is not one of your contacts." % (friend.get_full_name() or friend.username))
             return {}, {'url':redirect_to }
         if request.method == 'POST':
@@ -545,39 +551,54 @@ def edit_friends(request, friend=None, redirect_to='edit_friends', form_class=Fr
         else:
             friend_form=form_class(instance=friendship, user=request.user, friend=friend, prefix='friend')
     else:
+        # all of the user's outgoing friendships and their profiles in two
+        # queries; each one gets an unbound form, edits go through edit_friend
+        friendships = list(Friendship.objects.filter(from_user=request.user).select_related('to_user').order_by('to_user__last_name', 'to_user__first_name'))
+        get_profiles_for([f.to_user for f in friendships])
         friend_forms = []
-        friendship_list = get_friends(request.user)
-        counter = 0
-        for f in friendship_list:
-            counter += 1
-            friendship, _ = Friendship.objects.get_or_create(from_user=request.user, to_user=f['friend'])
-            friend_forms.append(form_class(instance=friendship, user=request.user, friend=f['friend'], prefix='friend_%s' % counter))
+        friendship_list = []
+        for friendship in friendships:
+            friend_form = form_class(instance=friendship, user=request.user, friend=friendship.to_user, prefix='friend_%s' % friendship.pk)
+            friend_forms.append(friend_form)
+            friendship_list.append({'friend': friendship.to_user, 'friendship': friendship, 'form': friend_form})
     return locals(), template_name
 
 @render_to()
 @login_required
-def recommended_friends(request, template_name="friends/recommended_friends.html"):
-    recommended_friends = FriendSuggestion.objects.filter(user=request.user)
-    recommended_friends = recommended_friends.exclude(suggested_user__friends__to_user=request.user) 
-    return locals(), template_name
+def recommended_friends(request, template_name="friends/recommended_friends.html", limit=50):
+    # served from the (user, active, -score) index; anyone who became a friend
+    # since the suggestions were built is dropped with one extra query
+    suggestions = list(FriendSuggestion.objects.filter(user=request.user, active=True).select_related('suggested_user').order_by('-score')[:limit])
+    friend_ids = Friendship.objects.are_friends_many(request.user, [s.suggested_user_id for s in suggestions])
+    recommended_friends = [s for s in suggestions if s.suggested_user_id not in friend_ids]
+    return {'recommended_friends': recommended_friends}, template_name
 
 @render_to()
 @login_required
-def addressbook(request, template_name="friends/addressbook.html"):
-    friends = [f['friend'] for f in Friendship.objects.friends_for_user(request.user)]
-    contact_list = Contact.objects.select_related("user").filter(owner=request.user)
+def addressbook(request, template_name="friends/addressbook.html", per_page=100):
+    # a fixed number of queries per page: friend IDs (usually cached), the
+    # count, the page of contacts with their users, and their profiles
+    friend_ids = set(Friendship.objects.friend_ids_for_user(request.user))
+    contact_list = Contact.objects.select_related("user").filter(owner=request.user).order_by('name', 'email', 'pk')
+    paginator = Paginator(contact_list, per_page)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    page_contacts = list(page.object_list)
+    profiles = get_profiles_for([contact.user for contact in page_contacts])
     contacts = []
-    for contact in contact_list:
-        c = {}
-        c['info']=contact
-        c['id']=contact.id
-        try:
-            c['user'] = contact.user
-            c['is_friend'] = contact.user in friends
-        except:
-            pass
-        contacts.append(c)
-    return {'contacts':contacts}, template_name
+    for contact in page_contacts:
+        contacts.append({
+            'info': contact,
+            'id': contact.id,
+            'user': contact.user,
+            'profile': profiles.get(contact.user_id),
+            'is_friend': contact.user_id in friend_ids,
+        })
+    return {'contacts':contacts, 'page':page}, template_name
 
 @render_to()
 @login_required
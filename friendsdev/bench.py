@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the friends hot paths.
+
+Builds a synthetic community in an in-memory SQLite database (see
+bench_settings.py and bench_data.py), then times each case and counts its
+queries. Each case runs once against a cold cache and then ``--repeat``
+times warm. The results are printed as JSON so runs on different commits
+can be diffed:
+
+    python friendsdev/bench.py --users 2000 --degree 20 > before.json
+
+Set FRIENDS_GRAPH_ENGINE=1 in the environment to benchmark with the
+in-memory graph turned on.
+"""
+import os
+import sys
+import time
+import json
+import subprocess
+from optparse import OptionParser
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'friendsdev.bench_settings')
+
+import django
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.contrib.auth.models import User
+
+import bench_data
+
+CASES = []
+
+
+def case(func):
+    """ Registers a benchmark case; it is called as func(context) """
+    CASES.append(func)
+    return func
+
+
+def measure(func, context, repeat):
+    def run():
+        reset_queries()
+        start = time.time()
+        func(context)
+        return time.time() - start, len(connection.queries)
+    cache.clear()
+    cold_seconds, cold_queries = run()
+    warm = sorted(run() for _ in range(max(1, repeat)))
+    return {
+        'cold_seconds': round(cold_seconds, 6),
+        'cold_queries': cold_queries,
+        'warm_seconds': round(warm[len(warm) // 2][0], 6),
+        'warm_min_seconds': round(warm[0][0], 6),
+        'warm_queries': warm[-1][1],
+    }
+
+
+@case
+def friends_for_user(context):
+    from friends.models import Friendship
+    Friendship.objects.friends_for_user(context['hub'])
+
+@case
+def are_friends(context):
+    from friends.models import Friendship
+    for user1, user2 in context['pairs']:
+        Friendship.objects.are_friends(user1, user2)
+
+@case
+def build_friend_suggestions(context):
+    from friends.utils import build_friend_suggestions
+    build_friend_suggestions(context['member'])
+
+@case
+def shared_friends(context):
+    from friends.utils import shared_friends
+    list(shared_friends(context['member'], context['hub']))
+
+@case
+def import_outlook(context):
+    from friends.importer import import_outlook
+    import_outlook(StringIO(context['outlook']), context['fresh_user']())
+
+@case
+def import_vcards(context):
+    from friends.importer import import_vcards
+    import_vcards(StringIO(context['vcards']), context['fresh_user']())
+
+@case
+def parse_vcards_native(context):
+    from friends.importer import iter_vcard_contacts
+    list(iter_vcard_contacts(context['vcards']))
+
+@case
+def parse_vcards_vobject(context):
+    from friends.importer import iter_vobject_contacts
+    list(iter_vobject_contacts(context['vcards']))
+
+@case
+def export_vcards(context):
+    from friends.exporter import export_vcards
+    from friends.models import Contact
+    export_vcards(Contact.objects.filter(owner=context['owner']))
+
+@case
+def addressbook(context):
+    from friends.views import addressbook
+    addressbook(context['request']('/friends/addressbook/'))
+
+@case
+def friend_lookup(context):
+    from friends.views import friend_lookup
+    friend_lookup(context['request']('/friends/lookup/', {'q': 'gra'}))
+
+
+def build(options):
+    """ Creates the synthetic data set and returns the context the cases share """
+    from django.test.client import RequestFactory
+    started = time.time()
+    # friends.management prints to stdout when notification is missing,
+    # which would corrupt the JSON output
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+    finally:
+        sys.stdout = stdout
+    user_ids = bench_data.create_users(options.users, seed=options.seed)
+    friendships = bench_data.create_friendships(user_ids, options.degree, seed=options.seed)
+    owner = User.objects.get(pk=user_ids[-1])
+    contacts = bench_data.create_contacts(owner, options.contacts, seed=options.seed)
+    from friends.models import Friendship
+    hub = User.objects.get(pk=user_ids[0])
+    member = User.objects.get(pk=user_ids[len(user_ids) // 2])
+    sample = User.objects.filter(pk__in=user_ids[:100])
+    pairs = [(hub, other) for other in sample]
+    counter = [0]
+
+    def fresh_user():
+        counter[0] += 1
+        return User.objects.create(username="importer%d" % counter[0], email="importer%d@example.com" % counter[0])
+
+    factory = RequestFactory()
+
+    def request(path, data=None):
+        r = factory.get(path, data or {})
+        r.user = owner
+        return r
+
+    context = {
+        'hub': hub,
+        'member': member,
+        'owner': owner,
+        'pairs': pairs,
+        'fresh_user': fresh_user,
+        'request': request,
+        'outlook': bench_data.outlook_csv(options.cards, seed=options.seed),
+        'vcards': bench_data.vcards(options.cards, seed=options.seed),
+    }
+    data = {
+        'users': len(user_ids),
+        'friendships': friendships,
+        'hub_friends': len(Friendship.objects.friend_ids_for_user(hub)),
+        'contacts': contacts,
+        'cards': options.cards,
+        'build_seconds': round(time.time() - started, 3),
+    }
+    return context, data
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--users', type='int', default=2000, help='Number of users in the friend graph.')
+    parser.add_option('--degree', type='int', default=20, help='Average number of friends per user.')
+    parser.add_option('--contacts', type='int', default=5000, help='Size of the benchmark address book.')
+    parser.add_option('--cards', type='int', default=1000, help='Contacts in the Outlook and vCard fixtures.')
+    parser.add_option('--repeat', type='int', default=5, help='Warm runs per case.')
+    parser.add_option('--seed', type='int', default=0, help='Random seed for the data generators.')
+    parser.add_option('--only', action='append', default=[], help='Run only the named case (may be repeated).')
+    options, args = parser.parse_args()
+
+    from django.conf import settings
+    context, data = build(options)
+    results = {}
+    for func in CASES:
+        name = func.__name__
+        if options.only and name not in options.only:
+            continue
+        try:
+            results[name] = measure(func, context, options.repeat)
+        except Exception, inst:
+            # e.g. vobject or django_rendering missing from this environment
+            results[name] = {'skipped': "%s: %s" % (inst.__class__.__name__, inst)}
+    output = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'django': django.get_version(),
+        'graph_engine': bool(getattr(settings, 'FRIENDS_GRAPH_ENGINE', False)),
+        'options': options.__dict__,
+        'data': data,
+        'results': results,
+    }
+    sys.stdout.write(json.dumps(output, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Synthetic data for the benchmark harness in bench.py.
+
+Every generator takes a ``seed`` so that two runs with the same arguments
+build exactly the same users, friendships, contacts and files.
+"""
+import random
+
+from django.contrib.auth.models import User
+
+from friends.models import Friendship, Contact, chunked, insert_batch_size
+
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Claude", "Donald", "Edsger", "Frances", "Grace", "John", "Ken",
+    "Leslie", "Margaret", "Niklaus", "Radia", "Shafi", "Tim", "Vint", "Whitfield", "Yukihiro", "Zhang"]
+LAST_NAMES = ["Allen", "Backus", "Cerf", "Diffie", "Dijkstra", "Goldwasser", "Hamilton", "Hopper", "Knuth", "Lamport",
+    "Liskov", "Lovelace", "McCarthy", "Perlman", "Ritchie", "Shannon", "Thompson", "Turing", "Wirth", "Wu"]
+DOMAINS = ["example.com", "example.org", "example.net", "mail.example.com"]
+
+
+def random_person(rnd, i):
+    first = rnd.choice(FIRST_NAMES)
+    last = rnd.choice(LAST_NAMES)
+    email = "%s.%s.%d@%s" % (first.lower(), last.lower(), i, rnd.choice(DOMAINS))
+    phone = "+1 555 %03d %04d" % (rnd.randint(0, 999), rnd.randint(0, 9999))
+    return first, last, email, phone
+
+
+def power_law_edges(n, degree, seed=0):
+    """
+    Returns the edges of a preferential-attachment graph on users 0..n-1:
+    each new user befriends about ``degree`` / 2 existing users, picked in
+    proportion to how many friends they already have, so a few hubs end up
+    with very large friend lists as in real communities.
+    """
+    rnd = random.Random(seed)
+    m = max(1, degree // 2)
+    edges = set()
+    targets = []
+    for i in range(1, n):
+        picks = set()
+        for _ in range(min(m, i)):
+            picks.add(targets and rnd.random() < 0.9 and rnd.choice(targets) or rnd.randrange(i))
+        for j in picks:
+            edges.add((j, i))
+            targets.extend((i, j))
+    return sorted(edges)
+
+
+def create_users(n, seed=0, prefix="bench"):
+    """ Bulk-creates ``n`` users and returns their IDs in creation order """
+    rnd = random.Random(seed)
+    users = []
+    for i in range(n):
+        first, last, email, _ = random_person(rnd, i)
+        users.append(User(username="%s%d" % (prefix, i), email=email, first_name=first, last_name=last, password="!"))
+    for batch in chunked(users, insert_batch_size(User)):
+        User.objects.bulk_create(batch)
+    return list(User.objects.filter(username__startswith=prefix).order_by('pk').values_list('pk', flat=True))
+
+
+def create_friendships(user_ids, degree, seed=0):
+    """ Befriends ``user_ids`` along a power-law graph; returns the number of friendships """
+    edges = power_law_edges(len(user_ids), degree, seed)
+    return Friendship.objects.bulk_befriend((user_ids[a], user_ids[b]) for a, b in edges) // 2
+
+
+def contact_rows(n, seed=0):
+    rnd = random.Random(seed)
+    for i in range(n):
+        first, last, email, phone = random_person(rnd, i)
+        yield {'first_name': first, 'last_name': last, 'email': email, 'phone': phone}
+
+
+def create_contacts(owner, n, seed=0):
+    """ Gives ``owner`` an address book of ``n`` imported contacts """
+    return Contact.objects.bulk_upsert(owner, contact_rows(n, seed), type='O')[0]
+
+
+def outlook_csv(n, seed=0):
+    """ Returns an Outlook CSV export with ``n`` contacts """
+    lines = ['"First Name","Last Name","E-mail Address","Business Phone","Business Street","Business City","Business State","Business Postal Code","Web Page"']
+    rnd = random.Random(seed)
+    for i in range(n):
+        first, last, email, phone = random_person(rnd, i)
+        lines.append('"%s","%s","%s","%s","%d Main St","Springfield","IL","62701","http://%s/"' % (
+            first, last, email, phone, rnd.randint(1, 9999), email.split('@')[1]))
+    return "\r\n".join(lines) + "\r\n"
+
+
+def vcards(n, seed=0):
+    """ Returns ``n`` vCard 3.0 cards, with some long lines folded """
+    cards = []
+    rnd = random.Random(seed)
+    for i in range(n):
+        first, last, email, phone = random_person(rnd, i)
+        cards.append("\r\n".join([
+            "BEGIN:VCARD",
+            "VERSION:3.0",
+            "N:%s;%s;;;" % (last, first),
+            "FN:%s %s" % (first, last),
+            "EMAIL;TYPE=INTERNET:%s" % email,
+            "TEL;TYPE=WORK:%s" % phone,
+            "TEL;TYPE=CELL:+1 555 %07d" % i,
+            "ADR;TYPE=WORK:;;%d Main St;Springfield;IL;62701;USA" % rnd.randint(1, 9999),
+            # a folded line: continuation lines start with a space
+            "NOTE:Met at the %d conference on distributed systems and progr\r\n amming languages" % (1990 + i % 30),
+            "END:VCARD",
+        ]))
+    return "\r\n".join(cards) + "\r\n"
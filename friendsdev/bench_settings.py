@@ -0,0 +1,50 @@
+# Settings for the benchmark harness in bench.py: an in-memory SQLite
+# database and the local-memory cache, so every run starts from the same
+# empty state.
+import os
+
+from settings import *
+
+# connection.queries is only recorded with DEBUG on
+DEBUG = True
+TEMPLATE_DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'friends-bench',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    }
+}
+
+ROOT_URLCONF = 'friendsdev.bench_urls'
+
+TEMPLATE_LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+)
+TEMPLATE_DIRS = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_templates'),
+)
+
+MIDDLEWARE_CLASSES = (
+    'django.middleware.common.CommonMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+)
+
+INSTALLED_APPS = INSTALLED_APPS + (
+    'django.contrib.messages',
+)
+
+OAUTH_SETTINGS = {}
+
+FRIENDS_GRAPH_ENGINE = os.environ.get('FRIENDS_GRAPH_ENGINE') == '1'